@@ -5,12 +5,16 @@ import base64
 import random
 import time
 import pickle
-import html
+import hashlib
 import logging
+import threading
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import List, Dict, Tuple, Optional
+from typing import Callable, List, Dict, Set, Tuple, Optional, Iterable, Iterator
 import pymupdf as fitz
-from PIL import Image
+from PIL import Image, features
 import io
 import requests
 from datetime import datetime
@@ -19,6 +23,11 @@ import genanki
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
+try:
+    import orjson  # Optional: faster JSON encoding/decoding
+except ImportError:
+    orjson = None
+
 
 class PromptTemplates:
     """Centralized prompt templates to avoid duplication."""
@@ -514,22 +523,49 @@ Format your response as a JSON array of flashcard objects, where each object has
 Return a JSON array with one object per slide:
 Example:
 [
-  {{
+  {
     "page_num": 1,
     "cards": [
-      {{
-        "text": "In type 2 diabetes, {{{{c1::Metformin}}}} is first-line because it {{{{c2::doesn't cause hypoglycemia}}}}",
+      {
+        "text": "In type 2 diabetes, {{c1::Metformin}} is first-line because it {{c2::doesn't cause hypoglycemia}}",
         "facts": ["Metformin", "doesn't cause hypoglycemia"],
         "context": "Essential diabetes management knowledge",
         "clinical_relevance": "Check renal function before prescribing"
-      }}
+      }
     ]
-  }}
+  }
 ]
 
 IMPORTANT: Include ALL slides / page_num in your response, even if a slide has no relevant medical content (return empty cards array for that slide).
 Make cards self-contained with clear, unambiguous cloze deletions that can be answered without lecture context.
 
+"""
+
+    @staticmethod
+    @lru_cache(maxsize=2)
+    def build_static_prefix(single_card_mode: bool) -> str:
+        """Get the slide analysis instructions that are identical for every lecture.
+
+        Kept ahead of any lecture-specific text so repeated requests share a
+        prompt prefix that OpenAI can serve from its prompt cache.
+        """
+        return f"""You are analyzing slides from a medical lecture to create Anki flashcards specifically for MEDICAL STUDENTS preparing for exams and clinical practice.
+        
+    Your PRIMARY GOAL: Create high-quality, unambiguous Anki flashcards that help medical students retain essential knowledge for both exams and patient care.
+
+{PromptTemplates.get_common_rules()}
+
+{PromptTemplates.get_cloze_examples()}
+
+{PromptTemplates.get_advanced_principles()}
+
+{PromptTemplates.get_percentage_guidelines()}
+
+{PromptTemplates.get_content_focus()}
+
+{PromptTemplates.get_cloze_instruction(single_card_mode)}
+
+{PromptTemplates.get_json_format()}
 """
 
     @staticmethod
@@ -594,13 +630,304 @@ WHY: Hint must be inside EACH cloze deletion: {{c1::shortness of breath::clinica
 
 OVERARCHING GOAL: Specific hints without giving away the answer are optimal. This is challenging however, and you should err on the side of ambiguity rather than specificity."""
 
+
+def _dump_json_bytes(obj, indent: bool = False) -> bytes:
+    """Serialize obj to UTF-8 JSON, using orjson when available.
+
+    Output is compact unless indent is set, which indents by two spaces for
+    files meant to be read by people.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else None)
+    if indent:
+        return json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8')
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def _load_json(data):
+    """Parse JSON from str or bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# Characters that change the nesting depth or start a string, per block type
+_JSON_TOKEN_PATTERNS = {
+    ('[', ']'): re.compile(r'[\[\]"]'),
+    ('{', '}'): re.compile(r'[{}"]'),
+}
+_JSON_STRING_PATTERN = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+
+
+def _extract_json_block(text: str, opener: str, closer: str, start: int = 0) -> Optional[str]:
+    """Return the first balanced JSON array/object in text at or after start, or None.
+
+    Walks forward from the first opener, skipping over string literals, and
+    stops at the matching closer instead of letting a greedy regex span the
+    whole model response. The regex engine jumps between brackets and quotes
+    so the scan does not step through every character in Python.
+    """
+    start = text.find(opener, start)
+    if start == -1:
+        return None
+    
+    token_pattern = _JSON_TOKEN_PATTERNS[(opener, closer)]
+    depth = 0
+    pos = start
+    while True:
+        token = token_pattern.search(text, pos)
+        if token is None:
+            return None
+        char = token.group()
+        if char == '"':
+            string_literal = _JSON_STRING_PATTERN.match(text, token.start())
+            if string_literal is None:
+                return None
+            pos = string_literal.end()
+            continue
+        pos = token.end()
+        depth += 1 if char == opener else -1
+        if depth == 0:
+            return text[start:pos]
+
+
+def _parse_json_block(text: str, opener: str, closer: str, is_expected: Callable[[object], bool]):
+    """Parse the first balanced JSON array/object in text that has the expected shape, or return None.
+
+    Prose before the JSON can contain stray brackets, so a block that fails
+    to parse is skipped and the search resumes at the next opener. Only a
+    block accepted by is_expected is returned: when the outer JSON of a
+    truncated response does not parse, the blocks nested inside it (a
+    slide's cards, a single card) must not be mistaken for the answer.
+    """
+    start = text.find(opener)
+    while start != -1:
+        json_text = _extract_json_block(text, opener, closer, start)
+        if json_text is not None:
+            try:
+                value = _load_json(json_text)
+            except ValueError:
+                value = None
+            if value is not None and is_expected(value):
+                return value
+        start = text.find(opener, start + 1)
+    return None
+
+
+def _is_slide_analysis(value) -> bool:
+    """Check for the slide analysis answer: a non-empty list of {"page_num", "cards"} objects."""
+    return (isinstance(value, list) and bool(value) and
+            all(isinstance(item, dict) and 'page_num' in item and isinstance(item.get('cards'), list)
+                for item in value))
+
+
+def _render_page(page, dpi: int, max_size: Optional[int] = None) -> Tuple[int, int, bytes]:
+    """Render a PDF page to raw RGB samples.
+
+    With max_size, the page is rasterized no larger than that many pixels on
+    its longest side instead of being rendered at dpi and scaled down later.
+    """
+    zoom = dpi / 72
+    if max_size:
+        zoom = min(zoom, max_size / max(page.rect.width, page.rect.height))
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csRGB, alpha=False)
+    return pix.width, pix.height, pix.samples
+
+
+# The PDF opened once by each rendering worker process
+_worker_document = None
+
+
+def _open_worker_document(pdf_path: str):
+    """ProcessPoolExecutor initializer: open the PDF once per worker process."""
+    global _worker_document
+    _worker_document = fitz.open(pdf_path)
+
+
+def _render_worker_page(page_index: int, dpi: int, max_size: Optional[int] = None) -> Tuple[int, int, bytes]:
+    """Render a page of the worker's PDF (top-level so worker processes can run it)."""
+    return _render_page(_worker_document[page_index], dpi, max_size)
+
+
+def _samples_to_image(width: int, height: int, samples: bytes) -> Image.Image:
+    """Wrap raw RGB pixmap samples as a PIL image without a PNG round trip."""
+    return Image.frombytes("RGB", (width, height), samples)
+
+
+_scratch = threading.local()
+
+
+def _scratch_buffer() -> io.BytesIO:
+    """Return this thread's reusable encode buffer, rewound to the start.
+
+    The buffer is deliberately not truncated (that would release its memory),
+    so callers must only read the first ``tell()`` bytes after writing.
+    """
+    buffer = getattr(_scratch, 'buffer', None)
+    if buffer is None:
+        buffer = _scratch.buffer = io.BytesIO()
+    buffer.seek(0)
+    return buffer
+
+
+class SlideRecord:
+    """A slide prepared for analysis: its page number, upload data URL and cache key."""
+    __slots__ = ('page_num', 'image_url', 'cache_key')
+
+    def __init__(self, page_num: int, image_url: str, cache_key: str = ''):
+        self.page_num = page_num
+        self.image_url = image_url
+        self.cache_key = cache_key
+
+
+class RefinedCard:
+    """A refined cloze card, slotted to keep large decks compact.
+
+    Supports card['field'] and card.get('field') so it can be used anywhere
+    the card dicts from slide analysis are.
+    """
+    __slots__ = ('text', 'facts', 'context', 'clinical_relevance')
+
+    def __init__(self, text: str, facts: Optional[List[str]] = None,
+                 context: str = '', clinical_relevance: str = ''):
+        self.text = text
+        self.facts = facts if facts is not None else []
+        self.context = context
+        self.clinical_relevance = clinical_relevance
+
+    def __getitem__(self, key: str):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key: str, default=None):
+        return getattr(self, key, default)
+
+
+class APIStatusError(Exception):
+    """A chat completion request answered with a non-200 status."""
+
+    def __init__(self, status_code: int, retry_after: Optional[str] = None):
+        super().__init__(f"API error {status_code}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class ResponseCache:
+    """Append-only JSON-lines store of API results, keyed by a hash of the request.
+
+    Card shards share one cache across threads, so loading, lookups and
+    appends all hold a lock.
+    """
+
+    def __init__(self, cache_file: Path, logger: logging.Logger):
+        self.cache_file = cache_file
+        self.logger = logger
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict:
+        """Read the cache file on first use; callers must hold the lock."""
+        if self._entries is None:
+            self._entries = {}
+            if self.cache_file.exists():
+                line_count = 0
+                with open(self.cache_file, 'rb') as f:
+                    for line in f:
+                        line_count += 1
+                        try:
+                            entry = _load_json(line)
+                            self._entries[entry['key']] = entry['value']
+                        except (ValueError, KeyError, TypeError):
+                            # A run interrupted mid-append can leave a partial last line
+                            self.logger.warning(f"Skipping unreadable line {line_count} of {self.cache_file}")
+                
+                # Entries are only ever appended, so compact superseded or broken
+                # lines into a temp file that replaces the cache in one step
+                if line_count > len(self._entries):
+                    temp_file = self.cache_file.with_name(self.cache_file.name + '.tmp')
+                    if self._write_lines(temp_file, self._entries, mode='wb'):
+                        os.replace(temp_file, self.cache_file)
+        return self._entries
+
+    def get(self, key: str):
+        with self._lock:
+            return self._load().get(key)
+
+    def update(self, new_entries: Dict):
+        """Add new entries and append them to the cache file."""
+        with self._lock:
+            self._load().update(new_entries)
+            self._write_lines(self.cache_file, new_entries, mode='ab')
+
+    def _write_lines(self, path: Path, entries: Dict, mode: str) -> bool:
+        """Write entries as JSON lines in a single write, returning whether it succeeded."""
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            data = b''.join(_dump_json_bytes({'key': key, 'value': value}) + b'\n' for key, value in entries.items())
+            with open(path, mode) as f:
+                f.write(data)
+            return True
+        except Exception as e:
+            self.logger.warning(f"Could not save {path}: {e}")
+            return False
+
+
 class MedicalAnkiGenerator:
+    # Single-pass escape tables for str.translate (html.escape chains a
+    # str.replace per character class)
+    _HTML_ESCAPE_TABLE = str.maketrans({
+        '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#x27;'
+    })
+    _HTML_TEXT_ESCAPE_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+    _PRESERVED_TAG_PATTERN = re.compile(r'(</?(?:b|strong|i|em)>)')
+    _CLOZE_NUMBER_PATTERN = re.compile(r'\{\{c\d+::')
+    _CLOZE_BRACE_PATTERN = re.compile(r'\{\{|\}\}')
+    # Medical terms, descriptors and doses, matched together in one pass
+    _KEY_TERM_PATTERN = re.compile(
+        r'\b(diagnosis|treatment|syndrome|disease|disorder|symptom|sign|pathophysiology|mechanism|receptor|enzyme|hormone|drug|medication|dose|contraindication|indication|complication|prognosis|etiology|differential|investigation|management)\b'
+        r'|\b(acute|chronic|primary|secondary|benign|malignant|systemic|focal|diffuse|bilateral|unilateral)\b'
+        r'|\b(\d+\s*(?:mg|mcg|g|kg|mL|L|mmHg|bpm|/min|/hr|/day|%|mmol|mg/dL))\b', re.IGNORECASE)
+    # Back-matter slides with nothing to learn; objectives and outline slides
+    # stay in the request because the prompt uses them to guide fact selection
+    _BOILERPLATE_HEADING_PATTERN = re.compile(
+        r'references?|bibliography|acknowledge?ments?|disclosures?', re.IGNORECASE)
+    # Rough completion tokens (cards plus reasoning) spent per analyzed slide,
+    # used to split large decks before one response outgrows its budget
+    _COMPLETION_TOKENS_PER_SLIDE = 2000
+    _MAX_COMPLETION_TOKENS = 100000
+    # Opt-in check for skipping stage 1 refinement on decks that already look clean
+    _CLOZE_ANSWER_PATTERN = re.compile(r'\{\{c\d+::(.*?)(?:::.*?)?\}\}')
+    _QUALITY_GATE_MAX_CARDS = 150
+    _QUALITY_GATE_MAX_ANSWER_LENGTH = 40
+    _QUALITY_GATE_PASS_RATIO = 0.9
+    # Hints, grouping and the ambiguity check work card by card, so larger
+    # decks are split into requests of this many cards
+    _REFINE_CARDS_PER_REQUEST = 40
+    # zlib effort for deck images; higher compression levels trade save time for smaller decks
+    _PNG_COMPRESS_LEVELS = {"none": 1, "low": 1, "medium": 6, "high": 9}
+    # Rough completion tokens (output plus reasoning) per card for each refinement
+    # stage; the floor leaves room for reasoning on small decks, and high
+    # reasoning effort gets a larger allowance and floor
+    _STAGE_COMPLETION_TOKENS_PER_CARD = {1: 350, 2: 200, 3: 150, 4: 250}
+    _STAGE_COMPLETION_TOKENS_OVERHEAD = 2000
+    _MIN_STAGE_COMPLETION_TOKENS = 16000
+    _HIGH_EFFORT_TOKENS_MULTIPLIER = 2
+    _MIN_HIGH_EFFORT_STAGE_COMPLETION_TOKENS = 32000
+    # Retries back off exponentially with jitter so concurrent runs don't retry in step
+    _RETRY_MAX_WAIT = 120
+    _RETRY_JITTER = 5
+
     def __init__(self, openai_api_key: str, single_card_mode: bool = True,  # Changed default to True
                 custom_tags: Optional[List[str]] = None, card_style: Optional[Dict] = None,
                 compression_level: str = "high",  # Changed default to "high"
                 test_mode: bool = False, 
                 add_hints: bool = True, # Changed default to True, removed batch_mode and preserve_quality
-                flex_mode: bool = False):  
+                flex_mode: bool = False, slides_per_request: Optional[int] = None,
+                max_concurrent_requests: int = 4, skip_boilerplate_slides: bool = True,
+                cache_dir: Optional[str] = ".ankify_cache", quality_gate: bool = False,
+                flex_refinement: bool = False, palette_images: bool = False):  
         self.api_key = openai_api_key
         self.single_card_mode = single_card_mode
         self.custom_tags = custom_tags or []
@@ -608,7 +935,20 @@ class MedicalAnkiGenerator:
         self.compression_level = compression_level
         self.test_mode = test_mode
         self.flex_mode = flex_mode
+        # Refinement runs after the slides are analyzed, so it can wait for the flex tier
+        self.flex_refinement = flex_mode or flex_refinement
         self.add_hints = add_hints
+        self.slides_per_request = slides_per_request
+        self.max_concurrent_requests = max_concurrent_requests
+        self.skip_boilerplate_slides = skip_boilerplate_slides
+        self.quality_gate = quality_gate
+        # Opt-in 256-colour deck images; banding shows on photos and scans
+        self.palette_images = palette_images
+        # Reasoning effort per refinement stage; hints and cloze regrouping are
+        # mechanical edits that don't need the deep semantic review of stages 1 and 4
+        self.stage_reasoning = {1: "high", 2: "medium", 3: "medium", 4: "high"}
+        # Single background thread so refinement logs are written in order
+        self._log_writer = ThreadPoolExecutor(max_workers=1)
         self.headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.api_key}"
@@ -617,22 +957,40 @@ class MedicalAnkiGenerator:
         # Setup logging
         self.setup_logging()
         
-        # Compression settings
+        # Results of earlier runs, so unchanged slides and cards are not re-sent;
+        # a cache_dir of None disables caching
+        if cache_dir:
+            self._slide_cache = ResponseCache(Path(cache_dir) / "slide_analysis.jsonl", self.logger)
+            self._stage_cache = ResponseCache(Path(cache_dir) / "refinement_stages.jsonl", self.logger)
+        else:
+            self._slide_cache = self._stage_cache = None
+        
+        # Compression settings; WebP is much smaller than JPEG for slide
+        # screenshots, with JPEG kept for Pillow builds without libwebp
+        api_format = "WEBP" if features.check("webp") else "JPEG"
         self.compression_settings = {
             "none": {"max_size": 1024, "quality": 95, "format": "PNG"},
-            "low": {"max_size": 1024, "quality": 90, "format": "JPEG"},
-            "medium": {"max_size": 800, "quality": 85, "format": "JPEG"},
-            "high": {"max_size": 512, "quality": 80, "format": "JPEG"}
+            "low": {"max_size": 1024, "quality": 90, "format": api_format},
+            "medium": {"max_size": 800, "quality": 85, "format": api_format},
+            "high": {"max_size": 512, "quality": 80, "format": api_format}
         }
         
-        # Setup session with retry strategy
+        # Setup session with retry strategy; one keep-alive session serves every
+        # call, and urllib3 only retries POST when it is listed explicitly.
+        # Read errors are not retried, since the server may already be
+        # generating (and billing) the completion, and rate limits are left to
+        # the callers' own loops, which cap how long Retry-After can stall them
         self.session = requests.Session()
         retry_strategy = Retry(
-            total=3,
+            total=2,
+            read=0,
             backoff_factor=1,
-            status_forcelist=[429, 500, 502, 503, 504],
+            status_forcelist=[500, 502, 503, 504],
+            allowed_methods=frozenset(["GET", "POST"]),
+            respect_retry_after_header=False,
+            raise_on_status=False,
         )
-        adapter = HTTPAdapter(max_retries=retry_strategy)
+        adapter = HTTPAdapter(max_retries=retry_strategy, pool_maxsize=max(10, max_concurrent_requests))
         self.session.mount("http://", adapter)
         self.session.mount("https://", adapter)
         
@@ -675,9 +1033,11 @@ class MedicalAnkiGenerator:
         if bold_color is None:
             bold_color = self._adjust_color_brightness(cloze_color, 2)
         
-        # Create a unique model ID based on style settings
-        style_hash = hash(str(self.card_style))
-        model_id = 1234567890 + (abs(style_hash) % 1000000)
+        # Create a unique model ID based on style settings; hash() is salted per
+        # process, so a digest of the sorted settings keeps the ID stable across runs
+        style_key = json.dumps(self.card_style, sort_keys=True).encode('utf-8')
+        style_hash = int.from_bytes(hashlib.blake2b(style_key, digest_size=4).digest(), 'big')
+        model_id = 1234567890 + (style_hash % 1000000)
         
         # Create model name that reflects custom styling
         style_desc = []
@@ -774,24 +1134,48 @@ class MedicalAnkiGenerator:
         except:
             return color
         
+    def get_page_count(self, pdf_path: str) -> int:
+        """Return the number of pages in a PDF."""
+        with fitz.open(pdf_path) as doc:
+            return len(doc)
+
     def pdf_to_images(self, pdf_path: str, dpi: int = 150) -> List[Tuple[Image.Image, int]]:
         """Convert PDF pages to images."""
-        doc = fitz.open(pdf_path)
-        images = []
+        return list(self.iter_pdf_images(pdf_path))
+
+    def iter_pdf_images(self, pdf_path: str, page_numbers: Optional[Iterable[int]] = None,
+                        max_size: Optional[int] = None) -> Iterator[Tuple[Image.Image, int]]:
+        """Yield (image, page_num) for the requested PDF pages, rendering them lazily."""
+        page_count = self.get_page_count(pdf_path)
+        if page_numbers is None:
+            page_numbers = range(1, page_count + 1)
+        page_numbers = [page_num for page_num in page_numbers if 1 <= page_num <= page_count]
         
         # Always use high DPI for extraction
         extraction_dpi = 300
         
-        for page_num in range(len(doc)):
-            page = doc[page_num]
-            mat = fitz.Matrix(extraction_dpi/72, extraction_dpi/72)
-            pix = page.get_pixmap(matrix=mat)
-            img_data = pix.tobytes("png")
-            img = Image.open(io.BytesIO(img_data))
-            images.append((img, page_num + 1))
-        
-        doc.close()
-        return images
+        # A 300 DPI page is ~15 MB of raw pixels, so pages are yielded one at a
+        # time instead of holding the whole lecture in memory
+        workers = min(os.cpu_count() or 1, 4, len(page_numbers))
+        if workers <= 1:
+            with fitz.open(pdf_path) as doc:
+                for page_num in page_numbers:
+                    yield _samples_to_image(*_render_page(doc[page_num - 1], extraction_dpi, max_size)), page_num
+            return
+        
+        # Rasterizing holds the GIL, so pages are rendered in separate processes
+        # (each opening the PDF once) with only a small window of pages in flight
+        with ProcessPoolExecutor(max_workers=workers, initializer=_open_worker_document,
+                                 initargs=(pdf_path,)) as executor:
+            in_flight = deque()
+            for page_num in page_numbers:
+                in_flight.append((page_num, executor.submit(_render_worker_page, page_num - 1, extraction_dpi, max_size)))
+                if len(in_flight) > workers * 2:
+                    done_page_num, job = in_flight.popleft()
+                    yield _samples_to_image(*job.result()), done_page_num
+            while in_flight:
+                done_page_num, job = in_flight.popleft()
+                yield _samples_to_image(*job.result()), done_page_num
 
     def image_to_base64(self, image: Image.Image, for_api: bool = True) -> str:
         """Convert PIL Image to base64 string with optional compression.
@@ -799,7 +1183,18 @@ class MedicalAnkiGenerator:
                 image: PIL Image to convert
                 for_api: If True, apply compression for API calls. If False, preserve quality.
         """
-        buffered = io.BytesIO()
+        encoded, _ = self._encode_image_base64(image, for_api)
+        return encoded.decode('ascii')
+    
+    def image_to_data_url(self, image: Image.Image) -> str:
+        """Encode an image for the API as a data URL carrying its real MIME type."""
+        encoded, img_format = self._encode_image_base64(image, for_api=True)
+        return f"data:image/{img_format.lower()};base64,{encoded.decode('ascii')}"
+    
+    def _encode_image_base64(self, image: Image.Image, for_api: bool) -> Tuple[bytes, str]:
+        """Encode an image, returning its base64 bytes and the format actually used."""
+        buffered = _scratch_buffer()
+        img_format = "PNG"
         
         if for_api and self.compression_level != "none":
             # Apply compression for API calls
@@ -808,10 +1203,12 @@ class MedicalAnkiGenerator:
             quality = settings["quality"]
             img_format = settings["format"]
             
-            # Create a copy to avoid modifying the original
-            img_copy = image.copy()
+            # Slides for the API are normally rendered at this size already,
+            # so only copy the original when it actually has to be shrunk
+            img_copy = image
             
             if max(img_copy.size) > max_size:
+                img_copy = image.copy()
                 img_copy.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
             
             if img_format == "JPEG" and img_copy.mode in ('RGBA', 'LA', 'P'):
@@ -825,87 +1222,99 @@ class MedicalAnkiGenerator:
                 img_copy.save(buffered, format=img_format, quality=quality, optimize=True)
             except Exception as e:
                 print(f"⚠️ Compression failed, using original: {str(e)}")
-                buffered = io.BytesIO()
+                buffered.seek(0)
+                img_format = "PNG"
                 image.save(buffered, format="PNG")
         else:
-            # For Anki cards - always preserve quality
-            image.save(buffered, format="PNG", optimize=False)
+            # Uncompressed uploads (--compress=none) stay lossless PNG; deck
+            # images are written by _save_slide_image, so this only feeds the
+            # API and keeps the default zlib level for a smaller request body
+            image.save(buffered, format="PNG")
         
-        return base64.b64encode(buffered.getvalue()).decode('utf-8')
+        # Base64 straight from the encode buffer rather than a copy of its contents
+        with buffered.getbuffer() as view:
+            return base64.b64encode(view[:buffered.tell()]), img_format
 
         
     def escape_html_but_preserve_formatting(self, text: str) -> str:
         """Escape HTML characters but preserve our formatting tags."""
-        text = html.escape(text, quote=False)
-        
-        # Restore specific formatting tags
-        replacements = [
-            ('&lt;b&gt;', '<b>'), ('&lt;/b&gt;', '</b>'),
-            ('&lt;strong&gt;', '<strong>'), ('&lt;/strong&gt;', '</strong>'),
-            ('&lt;i&gt;', '<i>'), ('&lt;/i&gt;', '</i>'),
-            ('&lt;em&gt;', '<em>'), ('&lt;/em&gt;', '</em>')
-        ]
-        
-        for old, new in replacements:
-            text = text.replace(old, new)
-        
-        return text
+        # Split around the tags we keep, then escape only the plain segments
+        # (even indices) in one translate pass each
+        parts = self._PRESERVED_TAG_PATTERN.split(text)
+        parts[::2] = [part.translate(self._HTML_TEXT_ESCAPE_TABLE) for part in parts[::2]]
+        return ''.join(parts)
     
     def convert_to_single_card_format(self, text: str) -> str:
         """Convert multiple cloze numbers (c1, c2, c3...) to all c1 for single card mode."""
-        if self.single_card_mode:
-            return re.sub(r'\{\{c\d+::', '{{c1::', text)
+        # Cards already numbered c1 throughout (the common case) need no rewrite
+        if self.single_card_mode and text.count('{{c') != text.count('{{c1::'):
+            return self._CLOZE_NUMBER_PATTERN.sub('{{c1::', text)
         return text
     
     def add_bold_formatting(self, text: str) -> str:
         """Add bold formatting to key medical terms not in cloze deletions."""
-        key_patterns = [
-            r'\b(diagnosis|treatment|syndrome|disease|disorder|symptom|sign|pathophysiology|mechanism|receptor|enzyme|hormone|drug|medication|dose|contraindication|indication|complication|prognosis|etiology|differential|investigation|management)\b',
-            r'\b(acute|chronic|primary|secondary|benign|malignant|systemic|focal|diffuse|bilateral|unilateral)\b',
-            r'\b(\d+\s*(?:mg|mcg|g|kg|mL|L|mmHg|bpm|/min|/hr|/day|%|mmol|mg/dL))\b'
-        ]
+        # Cloze braces in text order: +1 for each '{{', -1 for each '}}'
+        braces = [(m.start(), 1 if m.group() == '{{' else -1)
+                  for m in self._CLOZE_BRACE_PATTERN.finditer(text)]
+        next_brace = 0
+        open_clozes = 0
         
         def replace_if_not_in_cloze(match):
+            nonlocal next_brace, open_clozes
             term = match.group(0)
-            start = match.start()
-            before_text = text[:start]
-            if before_text.count('{{') > before_text.count('}}'):
+            # Matches arrive left to right, so advance past the braces that
+            # end before this one; the term is inside a cloze while more
+            # braces have been opened than closed
+            limit = match.start() - 2
+            while next_brace < len(braces) and braces[next_brace][0] <= limit:
+                open_clozes += braces[next_brace][1]
+                next_brace += 1
+            if open_clozes > 0:
                 return term
             return f'<b>{term}</b>'
         
-        for pattern in key_patterns:
-            text = re.sub(pattern, replace_if_not_in_cloze, text, flags=re.IGNORECASE)
-        
-        return text
+        return self._KEY_TERM_PATTERN.sub(replace_if_not_in_cloze, text)
     
     
     def _build_batch_analysis_prompt(self, num_slides: int, lecture_name: str) -> str:
         """Build the batch analysis prompt using centralized templates."""
-        cloze_instruction = PromptTemplates.get_cloze_instruction(self.single_card_mode)
-        
-        return f"""You are analyzing {num_slides} slides from a medical lecture on "{lecture_name}" to create Anki flashcards specifically for MEDICAL STUDENTS preparing for exams and clinical practice.
-        
-    Your PRIMARY GOAL: Create high-quality, unambiguous Anki flashcards that help medical students retain essential knowledge for both exams and patient care.
-
-{PromptTemplates.get_common_rules()}
-
-{PromptTemplates.get_cloze_examples()}
-
-{PromptTemplates.get_advanced_principles()}
-
-{PromptTemplates.get_percentage_guidelines()}
-
-{PromptTemplates.get_content_focus()}
-
-{cloze_instruction}
-
-{PromptTemplates.get_json_format()}
+        # Lecture-specific details go last so the static prefix stays cacheable
+        return f"""{PromptTemplates.build_static_prefix(self.single_card_mode)}
+The slides below are from a medical lecture on "{lecture_name}". There are {num_slides} slides to analyze.
 """
 
-    def analyze_slides_batch(self, images: List[Tuple[Image.Image, int]], lecture_name: str, max_retries: int = 3) -> List[Dict]:
-        """Send multiple slides to OpenAI API in a single batch request."""
-        print(f"\n🔄 Batch processing {len(images)} slides in a single API call...")
-        self.logger.info(f"Starting batch processing of {len(images)} slides")
+    def analyze_slides_batch(self, images: Iterable[Tuple[Image.Image, int]], lecture_name: str, max_retries: int = 3) -> List[Dict]:
+        """Analyze slides in one batch request, or in concurrent chunks when slides_per_request is set."""
+        # Prepare all images
+        slides_data = []
+        for img, page_num in images:
+            slides_data.append(SlideRecord(page_num, self.image_to_data_url(img)))
+            
+        self.logger.info(f"Prepared {len(slides_data)} images for batch processing")
+        
+        # Slides whose upload and prompt match an earlier run reuse that analysis
+        slide_cache = self._slide_cache
+        key_base = hashlib.blake2b(PromptTemplates.build_static_prefix(self.single_card_mode).encode('utf-8'), digest_size=16)
+        key_base.update(b"gpt-5")
+        # The lecture name is part of the prompt, so it is part of the key
+        key_base.update(lecture_name.encode('utf-8') + b'\0')
+        results = []
+        pending_slides = []
+        for slide in slides_data:
+            key = key_base.copy()
+            key.update(slide.image_url.encode('ascii'))
+            slide.cache_key = key.hexdigest()
+            cached_cards = slide_cache.get(slide.cache_key) if slide_cache is not None else None
+            if cached_cards is None:
+                pending_slides.append(slide)
+            else:
+                results.append({"page_num": slide.page_num, "cards": [dict(card) for card in cached_cards]})
+        
+        if results:
+            print(f"\n💾 Reusing cached analysis for {len(results)} unchanged slides")
+            self.logger.info(f"Slide cache hits: {len(results)}/{len(slides_data)}")
+        if not pending_slides:
+            return results
         
         # Test mode check
         if self.test_mode:
@@ -916,30 +1325,260 @@ class MedicalAnkiGenerator:
                 print("👋 Exiting test mode")
                 sys.exit(0)
         
-        # Prepare all images
-        slides_data = []
-        for img, page_num in images:
-            base64_image = self.image_to_base64(img, for_api=True)  # <-- Changed
-            slides_data.append({"page_num": page_num, "base64": base64_image})
+        chunk_size = self.slides_per_request or self._auto_chunk_size(len(pending_slides))
+        if not chunk_size or len(pending_slides) <= chunk_size:
+            chunks = [pending_slides]
+            chunk_results = [self._analyze_slide_chunk(pending_slides, lecture_name, max_retries)]
+        else:
+            chunks = [pending_slides[i:i + chunk_size] for i in range(0, len(pending_slides), chunk_size)]
+            workers = max(1, min(self.max_concurrent_requests, len(chunks)))
+            print(f"\n🔀 Splitting {len(pending_slides)} slides into {len(chunks)} requests ({workers} in flight at a time)")
+            self.logger.info(f"Analyzing {len(pending_slides)} slides in {len(chunks)} chunks with {workers} concurrent requests")
             
-        self.logger.info(f"Prepared {len(slides_data)} images for batch processing")
+            # Each request spends minutes waiting on the API, so threads are enough
+            # to overlap them; a failed chunk simply leaves its slides unfinished
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                chunk_results = list(executor.map(
+                    lambda chunk: self._analyze_slide_chunk(chunk, lecture_name, max_retries), chunks))
+        
+        new_results = []
+        new_entries = {}
+        for chunk, chunk_result in zip(chunks, chunk_results):
+            if not chunk_result:
+                continue
+            cache_keys = {slide.page_num: slide.cache_key for slide in chunk}
+            for slide_data in chunk_result:
+                try:
+                    page_num = int(slide_data.get('page_num'))
+                except (TypeError, ValueError):
+                    page_num = None
+                if page_num not in cache_keys:
+                    self.logger.warning(f"Ignoring analysis for unexpected slide {slide_data.get('page_num')!r}")
+                    continue
+                slide_data['page_num'] = page_num
+                new_entries[cache_keys.pop(page_num)] = [dict(card) for card in slide_data['cards']]
+                new_results.append(slide_data)
+            
+            # Slides the model left out count as done without cards, but are
+            # not cached so a later run analyzes them again
+            if cache_keys:
+                self.logger.warning(f"Missing slides in response: {set(cache_keys)}")
+                new_results.extend({"page_num": page_num, "cards": []} for page_num in cache_keys)
+        if new_entries and slide_cache is not None:
+            slide_cache.update(new_entries)
+        
+        results.extend(new_results)
+        results.sort(key=lambda x: x.get('page_num', 0))
+        return results
+    
+    def _auto_chunk_size(self, num_slides: int) -> Optional[int]:
+        """Pick an even request size for decks too large for one response, or None if one request fits."""
+        max_slides = max(1, self._MAX_COMPLETION_TOKENS // self._COMPLETION_TOKENS_PER_SLIDE)
+        if num_slides <= max_slides:
+            return None
+        num_chunks = -(-num_slides // max_slides)
+        return -(-num_slides // num_chunks)
+    
+    def _post_chat_completion(self, payload: Dict, timeout: int) -> requests.Response:
+        """POST a streaming chat completion request, serializing the payload with the fast JSON helper.
+
+        Streaming keeps bytes flowing on long generations, so the timeout
+        bounds the gap between chunks rather than the whole response.
+        """
+        return self.session.post(
+            "https://api.openai.com/v1/chat/completions",
+            headers=self.headers,
+            data=_dump_json_bytes(dict(payload, stream=True)),
+            timeout=timeout,
+            stream=True
+        )
+    
+    @staticmethod
+    def _response_content(response: requests.Response) -> Optional[str]:
+        """Return the message content of a streamed chat completion, joined from its SSE deltas.
+
+        Returns None when the completion was cut off at its token budget, so
+        callers retry it instead of parsing a truncated answer.
+        """
+        parts = []
+        other_lines = []
+        saw_data = False
+        finish_reason = None
+        for line in response.iter_lines():
+            if not line.strip():
+                # Blank lines only separate SSE events
+                continue
+            if not line.startswith(b'data: '):
+                other_lines.append(line)
+                continue
+            saw_data = True
+            data = line[6:]
+            if data == b'[DONE]':
+                break
+            for choice in _load_json(data).get('choices') or []:
+                piece = (choice.get('delta') or {}).get('content')
+                if piece:
+                    parts.append(piece)
+                finish_reason = choice.get('finish_reason') or finish_reason
+        if not saw_data and other_lines:
+            # The server answered with a plain, non-streamed completion
+            choice = _load_json(b'\n'.join(other_lines))['choices'][0]
+            if choice.get('finish_reason') == 'length':
+                return None
+            return choice['message']['content']
+        if finish_reason == 'length':
+            return None
+        return ''.join(parts)
+    
+    def _retry_wait(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """Seconds to wait before a retry, honouring a Retry-After header when one was sent."""
+        if retry_after:
+            try:
+                return min(self._RETRY_MAX_WAIT, max(0.0, float(retry_after)))
+            except ValueError:
+                pass
+        return min(self._RETRY_MAX_WAIT, 2 ** attempt + random.uniform(0, self._RETRY_JITTER))
+    
+    def _stage_payload(self, prompt: str, card_count: int, *stages: int) -> Dict:
+        """Build the chat completion payload for a prompt covering one or more refinement stages."""
+        reasoning_effort = self.stage_reasoning[stages[0]]
+        per_card = sum(self._STAGE_COMPLETION_TOKENS_PER_CARD[stage] for stage in stages)
+        min_tokens = self._MIN_STAGE_COMPLETION_TOKENS
+        if reasoning_effort == "high":
+            per_card *= self._HIGH_EFFORT_TOKENS_MULTIPLIER
+            min_tokens = self._MIN_HIGH_EFFORT_STAGE_COMPLETION_TOKENS
+        max_tokens = per_card * card_count + self._STAGE_COMPLETION_TOKENS_OVERHEAD
+        return {
+            "model": "gpt-5",
+            "messages": [{"role": "user", "content": prompt}],
+            "max_completion_tokens": min(self._MAX_COMPLETION_TOKENS, max(min_tokens, max_tokens)),
+            "reasoning_effort": reasoning_effort,
+            "service_tier": "flex" if self.flex_refinement else "default",
+            # Every stage answers with one JSON object, so let the API guarantee it
+            "response_format": {"type": "json_object"},
+        }
+    
+    def _request_card_stage(self, build_prompt, lecture_name: str, cards: List[Dict],
+                            stages: Tuple[int, ...], cards_key: str, *decisions_keys: str) -> Optional[Dict]:
+        """Run a refinement stage that treats each card on its own, splitting large decks into concurrent requests."""
+        size = self._REFINE_CARDS_PER_REQUEST
+        if len(cards) <= size:
+            return self._request_stage_result(self._stage_payload(build_prompt(lecture_name, cards), len(cards), *stages), cards_key)
+        
+        shards = [cards[i:i + size] for i in range(0, len(cards), size)]
+        workers = max(1, min(self.max_concurrent_requests, len(shards)))
+        print(f"🔀 Splitting {len(cards)} cards into {len(shards)} requests ({workers} in flight at a time)")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(
+                lambda shard: self._request_stage_result(self._stage_payload(build_prompt(lecture_name, shard), len(shard), *stages),
+                                                         cards_key),
+                shards))
+        if any(result is None for result in results):
+            return None
+        
+        # Stitch the shards back together, shifting card indexes to the whole deck
+        merged = {cards_key: []}
+        merged.update((key, []) for key in decisions_keys)
+        for shard_index, (shard, result) in enumerate(zip(shards, results)):
+            offset = shard_index * size
+            # A shard that came back without cards keeps its cards unchanged
+            merged[cards_key].extend(result.get(cards_key) or shard)
+            for key in decisions_keys:
+                for decision in result.get(key, []):
+                    if isinstance(decision.get('card_index'), int):
+                        decision = dict(decision, card_index=decision['card_index'] + offset)
+                    merged[key].append(decision)
+        return merged
+    
+    def _request_stage_result(self, payload: Dict, cards_key: str) -> Optional[Dict]:
+        """Run one refinement stage request, reusing the result of an identical earlier request.
+
+        Only a JSON object holding the stage's cards_key counts as a result;
+        anything else returns None and is never cached. A non-200 response
+        raises APIStatusError carrying its Retry-After header.
+        """
+        key = None
+        if self._stage_cache is not None:
+            # The service tier changes price and latency, not the answer
+            request = {k: v for k, v in payload.items() if k != 'service_tier'}
+            key = hashlib.blake2b(_dump_json_bytes(request), digest_size=16).hexdigest()
+            cached_result = self._stage_cache.get(key)
+            if cached_result is not None:
+                print("💾 Reusing cached result for identical cards")
+                self.logger.info("Refinement stage cache hit")
+                return cached_result
+        
+        timeout = 2400 if payload['service_tier'] == 'flex' else 1200
+        while True:
+            response = self._post_chat_completion(payload, timeout=timeout)
+            if response.status_code != 200:
+                # Raised so the stage's retry loop can honour Retry-After
+                retry_after = response.headers.get('Retry-After') if response.status_code == 429 else None
+                self.logger.error(f"Refinement stage API error: {response.status_code} - {response.text[:500]}")
+                response.close()
+                raise APIStatusError(response.status_code, retry_after)
+            content = self._response_content(response)
+            if content is not None:
+                break
+            
+            # Cut off at the token budget: ask again with twice the room rather
+            # than parse a truncated answer (the cache key keeps the first budget)
+            budget = payload['max_completion_tokens']
+            if budget >= self._MAX_COMPLETION_TOKENS:
+                self.logger.warning("Refinement stage response was cut off at the maximum token budget")
+                return None
+            payload = dict(payload, max_completion_tokens=min(self._MAX_COMPLETION_TOKENS, budget * 2))
+            print(f"✂️ Response cut off; retrying with {payload['max_completion_tokens']} completion tokens")
+            self.logger.warning(f"Refinement stage truncated at {budget} tokens; retrying with a larger budget")
+        
+        def is_expected(value) -> bool:
+            return isinstance(value, dict) and cards_key in value
+        
+        try:
+            result = _load_json(content)
+        except ValueError:
+            result = None
+        if result is None or not is_expected(result):
+            # Fall back to digging the object out of any surrounding text
+            result = _parse_json_block(content, '{', '}', is_expected)
+            if result is None:
+                return None
+        if key is not None:
+            self._stage_cache.update({key: result})
+        return result
+    
+    def _find_boilerplate_slides(self, pdf_path: str, page_numbers: List[int]) -> Set[int]:
+        """Find slides headed only 'References', 'Acknowledgements', 'Disclosures' and the like."""
+        boilerplate_slides = set()
+        with fitz.open(pdf_path) as doc:
+            for page_num in page_numbers:
+                lines = doc[page_num - 1].get_text("text").strip().splitlines()
+                heading = lines[0].strip().rstrip(':') if lines else ''
+                if self._BOILERPLATE_HEADING_PATTERN.fullmatch(heading):
+                    boilerplate_slides.add(page_num)
+        return boilerplate_slides
+    
+    def _analyze_slide_chunk(self, slides_data: List[SlideRecord], lecture_name: str, max_retries: int = 3) -> List[Dict]:
+        """Send multiple slides to OpenAI API in a single batch request."""
+        print(f"\n🔄 Batch processing {len(slides_data)} slides in a single API call...")
+        self.logger.info(f"Starting batch processing of {len(slides_data)} slides")
         
         # Build prompt with all slides
         slides_content = []
         for slide in slides_data:
             slides_content.extend([
-                {"type": "text", "text": f"SLIDE {slide['page_num']}:"},
-                {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{slide['base64']}"}}
+                {"type": "text", "text": f"SLIDE {slide.page_num}:"},
+                {"type": "image_url", "image_url": {"url": slide.image_url}}
             ])
         
-        prompt = self._build_batch_analysis_prompt(len(images), lecture_name)
+        prompt = self._build_batch_analysis_prompt(len(slides_data), lecture_name)
         content = [{"type": "text", "text": prompt}] + slides_content
         service_tier = "flex" if self.flex_mode else "default"
 
         payload = {
             "model": "gpt-5",
             "messages": [{"role": "user", "content": content}],
-            "max_completion_tokens": 100000,
+            "max_completion_tokens": self._MAX_COMPLETION_TOKENS,
             "reasoning_effort": "high",
             "service_tier": f"{service_tier}",
         }
@@ -949,79 +1588,65 @@ class MedicalAnkiGenerator:
         
         
         # Dynamic timeout based on number of slides (30 seconds per slide + 300 second buffer)
-        timeout_seconds = max(600, (len(images) * 30) + 300)
+        timeout_seconds = max(600, (len(slides_data) * 30) + 300)
         if self.flex_mode: timeout_seconds*=2
 
-        print(f"⏱️ Timeout set to {timeout_seconds} seconds ({timeout_seconds/60:.1f} minutes) for {len(images)} slides")
+        print(f"⏱️ Timeout set to {timeout_seconds} seconds ({timeout_seconds/60:.1f} minutes) for {len(slides_data)} slides")
 
+        retry_after = None
         for attempt in range(max_retries):
             try:
                 if attempt > 0:
-                    wait_time = (2 ** attempt) + random.uniform(0, 1)
+                    wait_time = self._retry_wait(attempt, retry_after)
+                    retry_after = None
                     print(f"\n  ⏳ Retry {attempt}/{max_retries} after {wait_time:.1f}s wait...", end='', flush=True)
                     time.sleep(wait_time)
                 
                 print(f"\n  📡 Sending API request (attempt {attempt + 1}/{max_retries})...", end='', flush=True)
-                response = self.session.post(
-                    "https://api.openai.com/v1/chat/completions",
-                    headers=self.headers,
-                    json=payload,
-                    timeout=timeout_seconds
-                )
+                response = self._post_chat_completion(payload, timeout=timeout_seconds)
                 
                 if response.status_code == 200:
-                    response_json = response.json()
-                    content = response_json['choices'][0]['message']['content']
+                    content = self._response_content(response)
+                    if content is None:
+                        print(f"\n  ✂️ Response was cut off at the token limit")
+                        self.logger.error("Batch response truncated (finish_reason: length)")
+                        continue
                     self.logger.info(f"Received response of length: {len(content)}")
                     
-                    json_match = re.search(r'\[[\s\S]*\]', content)
-                    if json_match:
-                        try:
-                            all_slides_data = json.loads(json_match.group())
-                            self.logger.info(f"Successfully parsed JSON with {len(all_slides_data)} slide entries")
-                            
-                            # Ensure we have data for all slides
-                            slide_nums_in_response = {item.get('page_num', 0) for item in all_slides_data}
-                            expected_slide_nums = set(range(1, len(images) + 1))
-                            missing_slides = expected_slide_nums - slide_nums_in_response
-                            
-                            if missing_slides:
-                                self.logger.warning(f"Missing slides in response: {missing_slides}")
-                                for slide_num in missing_slides:
-                                    all_slides_data.append({"page_num": slide_num, "cards": []})
-                            
-                            all_slides_data.sort(key=lambda x: x.get('page_num', 0))
-                            
-                            # Process and format the results
-                            processed_results = []
-                            total_cards = 0
-                            for slide_data in all_slides_data:
-                                cards = slide_data.get('cards', [])
-                                if self.single_card_mode:
-                                    for card in cards:
-                                        card['text'] = self.convert_to_single_card_format(card['text'])
-                                for card in cards:
-                                    card['text'] = self.add_bold_formatting(card['text'])
-                                
-                                processed_results.append({
-                                    "page_num": slide_data.get('page_num', 1),
-                                    "cards": cards
-                                })
-                                total_cards += len(cards)
-                            
-                            print(f"\n✅ Batch processing complete: {total_cards} cards generated from {len(images)} slides")
-                            self.logger.info(f"Batch processing successful: {total_cards} cards from {len(images)} slides")
-                            return processed_results
+                    all_slides_data = _parse_json_block(content, '[', ']', _is_slide_analysis)
+                    if all_slides_data is not None:
+                        self.logger.info(f"Successfully parsed JSON with {len(all_slides_data)} slide entries")
+                        
+                        # Process and format the results, with each card's text
+                        # renumbered (single card mode) and bolded in one visit
+                        renumber = self.convert_to_single_card_format if self.single_card_mode else None
+                        add_bold = self.add_bold_formatting
+                        processed_results = []
+                        total_cards = 0
+                        for slide_data in all_slides_data:
+                            cards = slide_data.get('cards', [])
+                            for card in cards:
+                                text = card['text']
+                                if renumber is not None:
+                                    text = renumber(text)
+                                card['text'] = add_bold(text)
                             
-                        except json.JSONDecodeError as e:
-                            print(f"\n  ❌ JSON parsing error: {str(e)[:100]}...")
-                            self.logger.error(f"JSON parsing failed: {str(e)}")
-                            self.logger.debug(f"Raw content: {content[:500]}...")
+                            processed_results.append({
+                                "page_num": slide_data['page_num'],
+                                "cards": cards
+                            })
+                            total_cards += len(cards)
+                        
+                        print(f"\n✅ Batch processing complete: {total_cards} cards generated from {len(slides_data)} slides")
+                        self.logger.info(f"Batch processing successful: {total_cards} cards from {len(slides_data)} slides")
+                        return processed_results
                     else:
-                        print(f"\n  ❌ No JSON array found in response")
-                        self.logger.error("No JSON array found in API response")
+                        print(f"\n  ❌ No valid JSON array found in response")
+                        self.logger.error("No valid JSON array found in API response")
                         self.logger.debug(f"Response content: {content[:500]}...")
                 else:
+                    # Rate limits that outlast the session's own retries say how long to back off
+                    retry_after = response.headers.get('Retry-After') if response.status_code == 429 else None
                     print(f"\n  ❌ API Error: {response.status_code}")
                     self.logger.error(f"Batch API error: {response.status_code} - {response.text[:500]}")
                     
@@ -1062,126 +1687,156 @@ class MedicalAnkiGenerator:
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         refinement_log_file = refinement_log_dir / f"{lecture_name}_refinement_{timestamp}.json"
         
-        # Prepare all cards for critique
+        all_decisions = []
+        
+        # Prepare all cards for critique, dropping exact duplicates locally
+        # rather than paying stage 1 to find them
         cards_for_review = []
+        seen_texts = set()
         total_original_cards = 0
         for slide_data in all_cards_data:
             for card in slide_data['cards']:
-                cards_for_review.append({
-                    'slide': slide_data['page_num'],
-                    'text': card['text'],
-                    'facts': card.get('facts', []),
-                    'context': card.get('context', ''),
-                    'clinical_relevance': card.get('clinical_relevance', ''),
-                    'original_index': total_original_cards
-                })
+                # Cards that differ only in cloze numbering count as exact duplicates
+                duplicate_key = ' '.join(self._CLOZE_NUMBER_PATTERN.sub('{{c::', card['text']).lower().split())
+                if duplicate_key in seen_texts:
+                    all_decisions.append({
+                        'action': 'removed',
+                        'stage': 'refinement',
+                        'original_index': total_original_cards,
+                        'reason': 'Exact duplicate of an earlier card'
+                    })
+                else:
+                    seen_texts.add(duplicate_key)
+                    cards_for_review.append({
+                        'slide': slide_data['page_num'],
+                        'text': card['text'],
+                        'facts': card.get('facts', []),
+                        'context': card.get('context', ''),
+                        'clinical_relevance': card.get('clinical_relevance', ''),
+                        'original_index': total_original_cards
+                    })
                 total_original_cards += 1
         
         print(f"📊 Analyzing {total_original_cards} cards for optimization...")
         self.logger.info(f"Total cards to analyze: {total_original_cards}")
+        if all_decisions:
+            print(f"🧹 Removed {len(all_decisions)} exact duplicate cards before refinement")
+            self.logger.info(f"Removed {len(all_decisions)} exact duplicates locally")
 
-        all_decisions = []
         hint_decisions = []
         grouping_decisions = []
         ambiguity_decisions = []
 
-        # Stage 1: Refinement only
-        print("\n📝 Stage 1/4: Initial refinement and quality improvement...")
-        prompt = self._build_critique_prompt_refinement_only(lecture_name, cards_for_review)
-
-        service_tier = "flex" if self.flex_mode else "default"
-        
-        payload = {
-            "model": "gpt-5",
-            "messages": [{"role": "user", "content": prompt}],
-            "max_completion_tokens": 100000,
-            "reasoning_effort": "high",
-            "service_tier": f"{service_tier}",
-        }
-        
         max_retries = 3
         refined_cards = None
         decisions = []
         
-        for attempt in range(max_retries):
-            try:
-                if attempt > 0:
-                    wait_time = 30 * attempt
-                    print(f"\n⏳ Retry {attempt}/{max_retries} after {wait_time}s wait...")
-                    time.sleep(wait_time)
+        # Stage 1: Refinement only
+        if self.quality_gate and self._cards_pass_quality_gate(cards_for_review):
+            print("\n⏭️ Stage 1/4: Skipping refinement (cards pass the quality checks)")
+            self.logger.info("Quality gate passed; skipping refinement stage")
+            refined_cards = [{k: v for k, v in card.items() if k != 'original_index'} for card in cards_for_review]
+        else:
+            print("\n📝 Stage 1/4: Initial refinement and quality improvement...")
+            payload = self._stage_payload(self._build_critique_prompt_refinement_only(lecture_name, cards_for_review),
+                                          len(cards_for_review), 1)
+        
+            retry_after = None
+            for attempt in range(max_retries):
+                try:
+                    if attempt > 0:
+                        wait_time = self._retry_wait(attempt, retry_after)
+                        retry_after = None
+                        print(f"\n⏳ Retry {attempt}/{max_retries} after {wait_time:.1f}s wait...")
+                        time.sleep(wait_time)
                 
-                response = self.session.post(
-                    "https://api.openai.com/v1/chat/completions",
-                    headers=self.headers,
-                    json=payload,
-                    timeout=1200
-                )
+                    result = self._request_stage_result(payload, 'refined_cards')
                 
-                if response.status_code == 200:
-                    content = response.json()['choices'][0]['message']['content']
-                    json_match = re.search(r'\{[\s\S]*\}', content)
-                    if json_match:
-                        result = json.loads(json_match.group())
+                    if result is not None:
                         refined_cards = result.get('refined_cards', [])
                         stage1_decisions = result.get('decisions', [])
                         for decision in stage1_decisions:
                             decision['stage'] = 'refinement'
                         all_decisions.extend(stage1_decisions)
                         break
-            except requests.exceptions.Timeout:
-                print(f"\n⏱️ Request timeout (attempt {attempt + 1}/{max_retries})")
-                if attempt == max_retries - 1:
-                    print("❌ Refinement failed after all retries")
-                    print("⚠️ Using original cards without refinement")
-                    return all_cards_data
+                except requests.exceptions.Timeout:
+                    print(f"\n⏱️ Request timeout (attempt {attempt + 1}/{max_retries})")
+                    if attempt == max_retries - 1:
+                        print("❌ Refinement failed after all retries")
+                        print("⚠️ Using original cards without refinement")
+                        return all_cards_data
                         
-            except Exception as e:
-                print(f"\n❗ Error during refinement: {str(e)}")
-                import traceback
-                traceback.print_exc()
-                if attempt == max_retries - 1:
-                    print("⚠️ Using original cards without refinement")
-                    return all_cards_data
-        
-        if not refined_cards:
-            print("⚠️ Stage 1 failed, using original cards")
-            self._save_refinement_logs(refinement_log_file, lecture_name, total_original_cards, refined_cards, all_decisions,hint_decisions,grouping_decisions,ambiguity_decisions)
-            return all_cards_data
-        
-        print(f"✅ Stage 1 complete: {total_original_cards} → {len(refined_cards)} cards")
-        
-        # Stage 2: Add hints (if enabled)
-        if self.add_hints and refined_cards:
-            print("\n💡 Stage 2/4: Adding descriptive hints...")
-            prompt = self._build_hints_only_prompt(lecture_name, refined_cards)
+                except Exception as e:
+                    retry_after = getattr(e, 'retry_after', None)
+                    print(f"\n❗ Error during refinement: {str(e)}")
+                    if not isinstance(e, APIStatusError):
+                        import traceback
+                        traceback.print_exc()
+                    if attempt == max_retries - 1:
+                        print("⚠️ Using original cards without refinement")
+                        return all_cards_data
             
-            payload = {
-                "model": "gpt-5",
-                "messages": [{"role": "user", "content": prompt}],
-                "max_completion_tokens": 100000,
-                "reasoning_effort": "high",
-                "service_tier": f"{service_tier}",
-            }
+            if not refined_cards:
+                print("⚠️ Stage 1 failed, using original cards")
+                self._save_refinement_logs(refinement_log_file, lecture_name, total_original_cards, refined_cards, all_decisions,hint_decisions,grouping_decisions,ambiguity_decisions)
+                return all_cards_data
             
+            print(f"✅ Stage 1 complete: {total_original_cards} → {len(refined_cards)} cards")
+        
+        # Stages 2 and 3: with both enabled, one request adds hints and regroups clozes
+        if self.add_hints and not self.single_card_mode and refined_cards:
+            print("\n💡 Stages 2-3/4: Adding descriptive hints and optimizing cloze grouping...")
+            retry_after = None
             for attempt in range(max_retries):
                 try:
                     if attempt > 0:
-                        wait_time = 30 * attempt
-                        print(f"\n⏳ Retry {attempt}/{max_retries} after {wait_time}s wait...")
+                        wait_time = self._retry_wait(attempt, retry_after)
+                        retry_after = None
+                        print(f"\n⏳ Retry {attempt}/{max_retries} after {wait_time:.1f}s wait...")
                         time.sleep(wait_time)
                     
-                    response = self.session.post(
-                        "https://api.openai.com/v1/chat/completions",
-                        headers=self.headers,
-                        json=payload,
-                        timeout=1200
-                    )
+                    result = self._request_card_stage(self._build_hints_and_grouping_prompt, lecture_name, refined_cards,
+                                                      (2, 3), 'cards_with_hints_and_grouping', 'hint_decisions', 'grouping_decisions')
                     
-                    if response.status_code == 200:
-                        content = response.json()['choices'][0]['message']['content']
-                        json_match = re.search(r'\{[\s\S]*\}', content)
-                        if json_match:
-                            result = json.loads(json_match.group())
+                    if result is not None:
+                        optimized_cards = result.get('cards_with_hints_and_grouping', [])
+                        hint_decisions = result.get('hint_decisions', [])
+                        grouping_decisions = result.get('grouping_decisions', [])
+                        
+                        if optimized_cards:
+                            refined_cards = optimized_cards
+                            for decision in hint_decisions:
+                                decision['stage'] = 'hints'
+                            for decision in grouping_decisions:
+                                decision['stage'] = 'grouping'
+                            all_decisions.extend(hint_decisions)
+                            all_decisions.extend(grouping_decisions)
+                            print(f"✅ Stages 2-3 complete: Hints added and grouping optimized for {len(refined_cards)} cards")
+                        break
+                            
+                except Exception as e:
+                    retry_after = getattr(e, 'retry_after', None)
+                    print(f"\n❗ Error during hint addition and grouping optimization: {str(e)}")
+                    if attempt == max_retries - 1:
+                        print("⚠️ Continuing without hints or grouping optimization")
+                        self._save_refinement_logs(refinement_log_file, lecture_name, total_original_cards, refined_cards, all_decisions,hint_decisions,grouping_decisions,ambiguity_decisions)
+        else:
+            # Stage 2: Add hints (if enabled)
+            if self.add_hints and refined_cards:
+                print("\n💡 Stage 2/4: Adding descriptive hints...")
+                retry_after = None
+                for attempt in range(max_retries):
+                    try:
+                        if attempt > 0:
+                            wait_time = self._retry_wait(attempt, retry_after)
+                            retry_after = None
+                            print(f"\n⏳ Retry {attempt}/{max_retries} after {wait_time:.1f}s wait...")
+                            time.sleep(wait_time)
+                    
+                        result = self._request_card_stage(self._build_hints_only_prompt, lecture_name, refined_cards,
+                                                          (2,), 'cards_with_hints', 'hint_decisions')
+                    
+                        if result is not None:
                             cards_with_hints = result.get('cards_with_hints', [])
                             hint_decisions = result.get('hint_decisions', [])
                             if cards_with_hints:
@@ -1192,50 +1847,35 @@ class MedicalAnkiGenerator:
                                 print(f"✅ Stage 2 complete: Hints added to {len(refined_cards)} cards")
                             break
                             
-                except Exception as e:
-                    print(f"\n❗ Error during hint addition: {str(e)}")
-                    if attempt == max_retries - 1:
-                        print("⚠️ Continuing without hints")
-                        self._save_refinement_logs(refinement_log_file, lecture_name, total_original_cards, refined_cards, all_decisions,hint_decisions,grouping_decisions,ambiguity_decisions)
+                    except Exception as e:
+                        retry_after = getattr(e, 'retry_after', None)
+                        print(f"\n❗ Error during hint addition: {str(e)}")
+                        if attempt == max_retries - 1:
+                            print("⚠️ Continuing without hints")
+                            self._save_refinement_logs(refinement_log_file, lecture_name, total_original_cards, refined_cards, all_decisions,hint_decisions,grouping_decisions,ambiguity_decisions)
 
-        else:
-            print("\n⏭️ Stage 2/4: Skipping hints (disabled)")
-        
-        # Stage 3: Optimize grouping (if not in single card mode)
-        if not self.single_card_mode and refined_cards:
-            print("\n🔄 Stage 3/4: Optimizing cloze grouping...")
-            prompt = self._build_grouping_only_prompt(lecture_name, refined_cards)
-            
-            payload = {
-                "model": "gpt-5",
-                "messages": [{"role": "user", "content": prompt}],
-                "max_completion_tokens": 100000,
-                "reasoning_effort": "high",
-                "service_tier": f"{service_tier}",
-            }
-            
-            for attempt in range(max_retries):
-                try:
-                    if attempt > 0:
-                        wait_time = 30 * attempt
-                        print(f"\n⏳ Retry {attempt}/{max_retries} after {wait_time}s wait...")
-                        time.sleep(wait_time)
+            else:
+                print("\n⏭️ Stage 2/4: Skipping hints (disabled)")
+        
+            # Stage 3: Optimize grouping (if not in single card mode)
+            if not self.single_card_mode and refined_cards:
+                print("\n🔄 Stage 3/4: Optimizing cloze grouping...")
+                retry_after = None
+                for attempt in range(max_retries):
+                    try:
+                        if attempt > 0:
+                            wait_time = self._retry_wait(attempt, retry_after)
+                            retry_after = None
+                            print(f"\n⏳ Retry {attempt}/{max_retries} after {wait_time:.1f}s wait...")
+                            time.sleep(wait_time)
                     
-                    response = self.session.post(
-                        "https://api.openai.com/v1/chat/completions",
-                        headers=self.headers,
-                        json=payload,
-                        timeout=1200
-                    )
+                        result = self._request_card_stage(self._build_grouping_only_prompt, lecture_name, refined_cards,
+                                                          (3,), 'optimized_cards', 'grouping_decisions')
                     
-                    if response.status_code == 200:
-                        content = response.json()['choices'][0]['message']['content']
-                        json_match = re.search(r'\{[\s\S]*\}', content)
-                        if json_match:
-                            result = json.loads(json_match.group())
+                        if result is not None:
                             optimized_cards = result.get('optimized_cards', [])
                             grouping_decisions = result.get('grouping_decisions', [])
-                        
+                    
                             if optimized_cards:
                                 refined_cards = optimized_cards
                                 for decision in grouping_decisions:
@@ -1244,66 +1884,52 @@ class MedicalAnkiGenerator:
                                 print(f"✅ Stage 3 complete: Grouping optimized for {len(refined_cards)} cards")
                             break
                             
-                except Exception as e:
-                    print(f"\n❗ Error during grouping optimization: {str(e)}")
-                    if attempt == max_retries - 1:
-                        print("⚠️ Using cards without grouping optimization")
-                        self._save_refinement_logs(refinement_log_file, lecture_name, total_original_cards, refined_cards, all_decisions,hint_decisions,grouping_decisions,ambiguity_decisions)
-        else:
-            print("\n⏭️ Stage 3/4: Skipping grouping (single card mode)")
+                    except Exception as e:
+                        retry_after = getattr(e, 'retry_after', None)
+                        print(f"\n❗ Error during grouping optimization: {str(e)}")
+                        if attempt == max_retries - 1:
+                            print("⚠️ Using cards without grouping optimization")
+                            self._save_refinement_logs(refinement_log_file, lecture_name, total_original_cards, refined_cards, all_decisions,hint_decisions,grouping_decisions,ambiguity_decisions)
+            else:
+                print("\n⏭️ Stage 3/4: Skipping grouping (single card mode)")
         
 
         # Stage 4: Final check
         if refined_cards:
             print("\n🔍 Stage 4/4: Final ambiguity check...")
-            prompt = self._build_ambiguity_check_prompt(lecture_name, refined_cards)
-            
-            payload = {
-                "model": "gpt-5",
-                "messages": [{"role": "user", "content": prompt}],
-                "max_completion_tokens": 100000,
-                "reasoning_effort": "high",
-                "service_tier": f"{service_tier}",
-            }
-            
+            retry_after = None
             for attempt in range(max_retries):
                 try:
                     if attempt > 0:
-                        wait_time = 30 * attempt
-                        print(f"\n⏳ Retry {attempt}/{max_retries} after {wait_time}s wait...")
+                        wait_time = self._retry_wait(attempt, retry_after)
+                        retry_after = None
+                        print(f"\n⏳ Retry {attempt}/{max_retries} after {wait_time:.1f}s wait...")
                         time.sleep(wait_time)
                     
-                    response = self.session.post(
-                        "https://api.openai.com/v1/chat/completions",
-                        headers=self.headers,
-                        json=payload,
-                        timeout=1200
-                    )
+                    result = self._request_card_stage(self._build_ambiguity_check_prompt, lecture_name, refined_cards,
+                                                      (4,), 'checked_cards', 'ambiguity_decisions')
                     
-                    if response.status_code == 200:
-                        content = response.json()['choices'][0]['message']['content']
-                        json_match = re.search(r'\{[\s\S]*\}', content)
-                        if json_match:
-                            result = json.loads(json_match.group())
-                            checked_cards = result.get('checked_cards', [])
-                            ambiguity_decisions = result.get('ambiguity_decisions', [])
-                
-                            if checked_cards:
-                                refined_cards = checked_cards
-                                # Add ambiguity decisions to the decisions log
-                                for decision in ambiguity_decisions:
-                                    if decision.get('action') == 'modified':
-                                        decisions.append({
-                                            'action': 'modified',
-                                            'stage': 'ambiguity_check',
-                                            'original_text': decision.get('original_text'),
-                                            'new_text': decision.get('new_text'),
-                                            'reason': decision.get('reason')
-                                        })
-                                print(f"✅ Stage 4 complete: {len([d for d in ambiguity_decisions if d.get('action') == 'modified'])} cards modified for clarity")
-                            break
+                    if result is not None:
+                        checked_cards = result.get('checked_cards', [])
+                        ambiguity_decisions = result.get('ambiguity_decisions', [])
+            
+                        if checked_cards:
+                            refined_cards = checked_cards
+                            # Add ambiguity decisions to the decisions log
+                            for decision in ambiguity_decisions:
+                                if decision.get('action') == 'modified':
+                                    decisions.append({
+                                        'action': 'modified',
+                                        'stage': 'ambiguity_check',
+                                        'original_text': decision.get('original_text'),
+                                        'new_text': decision.get('new_text'),
+                                        'reason': decision.get('reason')
+                                    })
+                            print(f"✅ Stage 4 complete: {len([d for d in ambiguity_decisions if d.get('action') == 'modified'])} cards modified for clarity")
+                        break
                             
                 except Exception as e:
+                    retry_after = getattr(e, 'retry_after', None)
                     print(f"\n❗ Error during ambiguity check: {str(e)}")
                     if attempt == max_retries - 1:
                         print("⚠️ Continuing without ambiguity check")
@@ -1321,13 +1947,50 @@ class MedicalAnkiGenerator:
         ambiguity_decisions
     )
         
+        # If no stage changed any card, keep the original (already formatted)
+        # cards instead of re-processing an identical copy
+        if (len(cards_for_review) == total_original_cards and
+                [self._card_signature(card) for card in refined_cards] == [self._card_signature(card) for card in cards_for_review]):
+            print("✅ Refinement made no changes, keeping original cards")
+            self.logger.info("Refinement produced no changes; reusing original cards")
+            return all_cards_data
+        
         # Validate and organize refined cards
         return self._process_refined_cards(refined_cards)
+    
+    def _cards_pass_quality_gate(self, cards: List[Dict]) -> bool:
+        """Check whether cards look clean enough to skip the stage 1 refinement call."""
+        if not cards or len(cards) > self._QUALITY_GATE_MAX_CARDS:
+            return False
+        
+        seen_texts = set()
+        passing = 0
+        for card in cards:
+            text = card.get('text', '')
+            normalized = ' '.join(text.lower().split())
+            if normalized in seen_texts:
+                # Duplicates are exactly what stage 1 is there to remove
+                return False
+            seen_texts.add(normalized)
+            
+            answers = self._CLOZE_ANSWER_PATTERN.findall(text)
+            if (answers and card.get('facts')
+                    and all(len(answer) <= self._QUALITY_GATE_MAX_ANSWER_LENGTH for answer in answers)):
+                passing += 1
+        
+        return passing >= self._QUALITY_GATE_PASS_RATIO * len(cards)
+    
+    @staticmethod
+    def _card_signature(card: Dict) -> Tuple:
+        """Fields that define a card's content, used to detect no-op refinement."""
+        return (card.get('slide', 1), card.get('text', ''), tuple(card.get('facts', [])),
+                card.get('context', ''), card.get('clinical_relevance', ''))
      
     def _build_critique_prompt_refinement_only(self, lecture_name: str, cards_for_review: List[Dict]) -> str:
         """Build the critique prompt without hints or grouping instructions."""
-        
-        return f"""You are an expert medical educator reviewing cloze deletion flashcards from a lecture on "{lecture_name}".
+        # Static instructions come first and the lecture name and cards last,
+        # so every request shares a cacheable prompt prefix
+        return f"""You are an expert medical educator reviewing cloze deletion flashcards from a medical lecture.
 
     CRITICAL INSTRUCTIONS:
     1. ALL cards MUST remain in cloze deletion format 
@@ -1364,7 +2027,7 @@ class MedicalAnkiGenerator:
     10. ENSURE all abbreviations are spelled out at least once
     11. REMOVE DUPLICATE CARDS - if multiple cards test the same concept, keep only the best one
 
-    Review these {len(cards_for_review)} cloze deletion flashcards and optimize them by:
+    Review the cloze deletion flashcards below and optimize them by:
 
     1. MAINTAINING good cloze patterns - don't make them more ambiguous
     2. ENSURING each card remains self-contained and understandable
@@ -1398,9 +2061,6 @@ class MedicalAnkiGenerator:
     10. ADDING clinical pearls that help with real patient care
     11. ENSURING medical accuracy while keeping appropriate depth
 
-    Current flashcards:
-    {json.dumps(cards_for_review, indent=2)}
-
     Return a JSON object with TWO arrays:
     {{
     "refined_cards": [
@@ -1436,11 +2096,16 @@ class MedicalAnkiGenerator:
     ]
     }}
 
-    ⚠️ REMEMBER: The goal is to REFINE cards while MAINTAINING their good cloze deletion patterns. Do not make cards more ambiguous in the name of brevity. Each card must be answerable without having seen the lecture."""
+    ⚠️ REMEMBER: The goal is to REFINE cards while MAINTAINING their good cloze deletion patterns. Do not make cards more ambiguous in the name of brevity. Each card must be answerable without having seen the lecture.
+
+    The {len(cards_for_review)} flashcards below are from a lecture on "{lecture_name}".
+
+    Current flashcards:
+    {_dump_json_bytes(cards_for_review).decode('utf-8')}"""
 
     def _build_hints_only_prompt(self, lecture_name: str, cards: List[Dict]) -> str:
         """Build prompt for adding hints only."""
-        return f"""You are adding descriptive hints to medical flashcards from "{lecture_name}" for MEDICAL STUDENTS.
+        return f"""You are adding descriptive hints to medical flashcards from a lecture for MEDICAL STUDENTS.
 
     PRIMARY GOAL: Ensure every Anki flashcard has appropriate hints to help medical students learn effectively.
 
@@ -1455,9 +2120,6 @@ class MedicalAnkiGenerator:
     - Provide a reason for each hint decision
     - Format: {{{{c1::answer::hint}}}}
 
-    Current cards WITHOUT hints:
-    {json.dumps(cards, indent=2)}
-
     Return JSON:
     {{
         "cards_with_hints": [
@@ -1483,12 +2145,17 @@ class MedicalAnkiGenerator:
                 "reason": "No hint needed - answer is unambiguous in context"
             }}
         ]
-    }}"""
+    }}
+
+    The cards below are from a lecture on "{lecture_name}".
+
+    Current cards WITHOUT hints:
+    {_dump_json_bytes(cards).decode('utf-8')}"""
 
     def _build_grouping_only_prompt(self, lecture_name: str, cards: List[Dict]) -> str:
         """Build prompt for optimizing cloze grouping only."""
 
-        return f"""You are optimizing cloze number grouping for medical flashcards from "{lecture_name}" specifically for MEDICAL STUDENTS.
+        return f"""You are optimizing cloze number grouping for medical flashcards from a lecture specifically for MEDICAL STUDENTS.
 
     PRIMARY GOAL: Create Anki flashcards that help medical students effectively learn and retain clinical knowledge.
 
@@ -1501,9 +2168,6 @@ class MedicalAnkiGenerator:
     - ONLY adjust cloze numbers (c1, c2, c3, etc.)
     - Provide a reason for each grouping decision
 
-    Current cards WITH hints:
-    {json.dumps(cards, indent=2)}
-
     Return JSON:
     {{
         "optimized_cards": [
@@ -1524,11 +2188,77 @@ class MedicalAnkiGenerator:
                 "reason": "Symptoms of the same disease should be learned together"
             }}
         ]
-    }}"""
+    }}
+
+    The cards below are from a lecture on "{lecture_name}".
+
+    Current cards WITH hints:
+    {_dump_json_bytes(cards).decode('utf-8')}"""
+
+    def _build_hints_and_grouping_prompt(self, lecture_name: str, cards: List[Dict]) -> str:
+        """Build prompt for adding hints and optimizing cloze grouping in one pass."""
+        return f"""You are adding descriptive hints to and optimizing cloze number grouping for medical flashcards from a lecture for MEDICAL STUDENTS.
+
+    PRIMARY GOAL: Ensure every Anki flashcard has appropriate hints and uses the fewest cards that still help medical students learn effectively.
+
+    TASK 1 - HINTS: Add hints to ALL cloze deletions where they would reduce ambiguity. A hint should be present for EVERY cloze unless it would provide no value.
+
+    {PromptTemplates.get_hint_instructions()}
+
+    TASK 2 - GROUPING: Optimize cloze number assignments to create the fewest cards while maintaining clarity.
+
+    {PromptTemplates.get_fine_tuned_cloze_principles()}
+
+    CRITICAL RULES:
+    - DO NOT change the card text except for adding hints and adjusting cloze numbers (c1, c2, c3, etc.)
+    - MUST add hints to ALL clozes unless they provide zero value
+    - Provide a reason for each hint decision and each grouping decision
+    - Format: {{{{c1::answer::hint}}}}
+
+    Return JSON:
+    {{
+        "cards_with_hints_and_grouping": [
+            {{
+                "slide": 1,
+                "text": "Card with optimized {{{{c1::answer::appropriate_hint}}}} numbers",
+                "facts": ["fact1"],
+                "context": "Context",
+                "clinical_relevance": "Clinical pearl",
+                "grouping_reason": "Grouped symptoms together as they represent related clinical features of the same condition"
+            }}
+        ],
+        "hint_decisions": [
+            {{
+                "card_index": 0,
+                "cloze": "c1::answer",
+                "hint_added": "appropriate_hint",
+                "reason": "Added 'drug class' hint to distinguish from other treatment options"
+            }},
+            {{
+                "card_index": 0,
+                "cloze": "c2::obvious_answer",
+                "hint_added": null,
+                "reason": "No hint needed - answer is unambiguous in context"
+            }}
+        ],
+        "grouping_decisions": [
+            {{
+                "card_index": 0,
+                "original_cloze_pattern": "c1, c2, c3 for individual symptoms",
+                "new_cloze_pattern": "all c1 for grouped symptoms",
+                "reason": "Symptoms of the same disease should be learned together"
+            }}
+        ]
+    }}
+
+    The cards below are from a lecture on "{lecture_name}".
+
+    Current cards WITHOUT hints:
+    {_dump_json_bytes(cards).decode('utf-8')}"""
 
     def _build_ambiguity_check_prompt(self, lecture_name: str, cards: List[Dict]) -> str:
         """Build prompt for final ambiguity check."""
-        return f"""You are performing a final ambiguity check on medical flashcards from "{lecture_name}" for MEDICAL STUDENTS.
+        return f"""You are performing a final ambiguity check on medical flashcards from a lecture for MEDICAL STUDENTS.
 
     PRIMARY GOAL: Ensure every Anki flashcard is unambiguous and appropriately challenging for medical student learning.
 
@@ -1553,9 +2283,6 @@ class MedicalAnkiGenerator:
     Action: ADD CONTEXT
     New: A careful seizure history guides {{{{c1::seizure classification::seizure diagnosis}}}}, {{{{c1::epilepsy syndrome diagnosis::epilepsy diagnosis}}}}, and {{{{c1::antiseizure medication titration::management}}}}.
 
-    Current cards:
-    {json.dumps(cards, indent=2)}
-
     Return JSON:
     {{
         "checked_cards": [
@@ -1582,29 +2309,47 @@ class MedicalAnkiGenerator:
                 "reason": "Added disease context to reduce ambiguity from >100 to <10 possible answers"
             }}
         ]
-    }}"""
+    }}
+
+    The cards below are from a lecture on "{lecture_name}".
+
+    Current cards:
+    {_dump_json_bytes(cards).decode('utf-8')}"""
 
     def _save_refinement_logs(self, refinement_log_file: Path, lecture_name: str, 
                                         total_original_cards: int, refined_cards: List[Dict], 
                                         all_decisions: List[Dict], hint_decisions: List[Dict],
                                         grouping_decisions: List[Dict], ambiguity_decisions: List[Dict]):
         """Save comprehensive refinement logs from all stages."""
+        # Tally every decision by stage and action in one pass
+        stage_action_counts = Counter()
+        action_counts = Counter()
+        refinement_decisions = []
+        for d in all_decisions:
+            stage, action = d.get('stage'), d.get('action')
+            stage_action_counts[stage, action] += 1
+            action_counts[action] += 1
+            if stage == 'refinement':
+                refinement_decisions.append(d)
+        hints_added = sum(1 for d in hint_decisions if d.get('hint_added'))
+        ambiguity_fixes = sum(1 for d in ambiguity_decisions if d.get('action') == 'modified')
+        
         refinement_data = {
             "lecture": lecture_name,
             "timestamp": datetime.now().isoformat(),
             "original_count": total_original_cards,
             "refined_count": len(refined_cards),
-            "all_decisions": all_decisions,
+            "all_decisions": list(all_decisions),
             "stage_breakdown": {
                 "stage1_refinement": {
-                    "decisions": [d for d in all_decisions if d.get('stage') == 'refinement'],
-                    "removed": len([d for d in all_decisions if d.get('stage') == 'refinement' and d.get('action') == 'removed']),
-                    "merged": len([d for d in all_decisions if d.get('stage') == 'refinement' and d.get('action') == 'merged']),
-                    "modified": len([d for d in all_decisions if d.get('stage') == 'refinement' and d.get('action') == 'modified'])
+                    "decisions": refinement_decisions,
+                    "removed": stage_action_counts['refinement', 'removed'],
+                    "merged": stage_action_counts['refinement', 'merged'],
+                    "modified": stage_action_counts['refinement', 'modified']
                 },
                 "stage2_hints": {
                     "decisions": hint_decisions,
-                    "hints_added": len([d for d in hint_decisions if d.get('hint_added')])
+                    "hints_added": hints_added
                 },
                 "stage3_grouping": {
                     "decisions": grouping_decisions,
@@ -1612,119 +2357,136 @@ class MedicalAnkiGenerator:
                 },
                 "stage4_ambiguity": {
                     "decisions": ambiguity_decisions,
-                    "modified": len([d for d in ambiguity_decisions if d.get('action') == 'modified'])
+                    "modified": ambiguity_fixes
                 }
             },
             "summary": {
                 "total_decisions": len(all_decisions),
-                "removed": len([d for d in all_decisions if d.get('action') == 'removed']),
-                "merged": len([d for d in all_decisions if d.get('action') == 'merged']),
-                "modified": len([d for d in all_decisions if d.get('action') == 'modified']),
-                "hints_added": len([d for d in hint_decisions if d.get('hint_added')]),
+                "removed": action_counts['removed'],
+                "merged": action_counts['merged'],
+                "modified": action_counts['modified'],
+                "hints_added": hints_added,
                 "grouping_changes": len(grouping_decisions),
-                "ambiguity_fixes": len([d for d in ambiguity_decisions if d.get('action') == 'modified'])
+                "ambiguity_fixes": ambiguity_fixes
             }
         }
         
-        # Save JSON log
-        with open(refinement_log_file, 'w', encoding='utf-8') as f:
-            json.dump(refinement_data, f, indent=2, ensure_ascii=False)
-        
-        print(f"📝 Comprehensive refinement log saved to: {refinement_log_file}")
+        stage1_data = refinement_data['stage_breakdown']['stage1_refinement']
+        stage2_data = refinement_data['stage_breakdown']['stage2_hints']
+        stage3_data = refinement_data['stage_breakdown']['stage3_grouping']
+        stage4_data = refinement_data['stage_breakdown']['stage4_ambiguity']
+        self.logger.info(f"Multi-stage refinement complete:")
+        self.logger.info(f"  Stage 1: {stage1_data['removed']} removed, {stage1_data['merged']} merged, {stage1_data['modified']} modified")
+        self.logger.info(f"  Stage 2: {stage2_data['hints_added']} hints added")
+        self.logger.info(f"  Stage 3: {stage3_data['regrouped']} cards regrouped")
+        self.logger.info(f"  Stage 4: {stage4_data['modified']} cards clarified")
         
-        # Create human-readable summary
-        summary_file = refinement_log_file.with_suffix('.txt')
-        with open(summary_file, 'w', encoding='utf-8') as f:
-            f.write(f"Multi-Stage Refinement Summary for {lecture_name}\n")
-            f.write(f"{'='*60}\n")
-            f.write(f"Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write(f"Original cards: {total_original_cards}\n")
-            f.write(f"Final refined cards: {len(refined_cards)}\n")
+        # Writing the files overlaps with the next API call or package build
+        print(f"📝 Saving refinement log to: {refinement_log_file} (summary: {refinement_log_file.with_suffix('.txt').name})")
+        self._log_writer.submit(self._write_refinement_logs, refinement_log_file, refinement_data)
+    
+    def _write_refinement_logs(self, refinement_log_file: Path, refinement_data: Dict):
+        """Write the JSON refinement log and its human-readable summary."""
+        try:
+            lecture_name = refinement_data['lecture']
+            total_original_cards = refinement_data['original_count']
+            refined_count = refinement_data['refined_count']
+            all_decisions = refinement_data['all_decisions']
+        
+            # Save JSON log
+            with open(refinement_log_file, 'wb') as f:
+                f.write(_dump_json_bytes(refinement_data, indent=True))
+        
+            stage_breakdown = refinement_data['stage_breakdown']
+            stage1_data = stage_breakdown['stage1_refinement']
+            parts = [
+                f"Multi-Stage Refinement Summary for {lecture_name}\n",
+                f"{'='*60}\n",
+                f"Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n",
+                f"Original cards: {total_original_cards}\n",
+                f"Final refined cards: {refined_count}\n",
+            ]
             if total_original_cards > 0:
-                reduction_percent = (1 - len(refined_cards)/total_original_cards) * 100
-                f.write(f"Overall reduction: {total_original_cards - len(refined_cards)} cards ({reduction_percent:.1f}%)\n\n")
-            
-            f.write("STAGE-BY-STAGE BREAKDOWN:\n")
-            f.write("-"*60 + "\n\n")
+                reduction_percent = (1 - refined_count/total_original_cards) * 100
+                parts.append(f"Overall reduction: {total_original_cards - refined_count} cards ({reduction_percent:.1f}%)\n\n")
             
-            # Stage 1 summary
-            f.write("STAGE 1: Initial Refinement\n")
-            stage1_data = refinement_data['stage_breakdown']['stage1_refinement']
-            f.write(f"  Removed: {stage1_data['removed']} cards\n")
-            f.write(f"  Merged: {stage1_data['merged']} cards\n")
-            f.write(f"  Modified: {stage1_data['modified']} cards\n\n")
-            
-            # Stage 2 summary
-            f.write("STAGE 2: Hint Addition\n")
-            stage2_data = refinement_data['stage_breakdown']['stage2_hints']
-            f.write(f"  Hints added: {stage2_data['hints_added']}\n\n")
-            
-            # Stage 3 summary
-            f.write("STAGE 3: Grouping Optimization\n")
-            stage3_data = refinement_data['stage_breakdown']['stage3_grouping']
-            f.write(f"  Cards regrouped: {stage3_data['regrouped']}\n\n")
-            
-            # Stage 4 summary
-            f.write("STAGE 4: Ambiguity Check\n")
-            stage4_data = refinement_data['stage_breakdown']['stage4_ambiguity']
-            f.write(f"  Cards modified for clarity: {stage4_data['modified']}\n\n")
-            
-            f.write("-"*60 + "\n")
-            f.write("DETAILED DECISIONS:\n")
-            f.write("-"*60 + "\n\n")
+            parts += [
+                "STAGE-BY-STAGE BREAKDOWN:\n",
+                "-"*60 + "\n\n",
+                # Stage 1 summary
+                "STAGE 1: Initial Refinement\n",
+                f"  Removed: {stage1_data['removed']} cards\n",
+                f"  Merged: {stage1_data['merged']} cards\n",
+                f"  Modified: {stage1_data['modified']} cards\n\n",
+                # Stage 2 summary
+                "STAGE 2: Hint Addition\n",
+                f"  Hints added: {stage_breakdown['stage2_hints']['hints_added']}\n\n",
+                # Stage 3 summary
+                "STAGE 3: Grouping Optimization\n",
+                f"  Cards regrouped: {stage_breakdown['stage3_grouping']['regrouped']}\n\n",
+                # Stage 4 summary
+                "STAGE 4: Ambiguity Check\n",
+                f"  Cards modified for clarity: {stage_breakdown['stage4_ambiguity']['modified']}\n\n",
+                "-"*60 + "\n",
+                "DETAILED DECISIONS:\n",
+                "-"*60 + "\n\n",
+            ]
             
-            # Write detailed decisions by stage
+            # Detailed decisions by stage
+            decisions_by_stage = {}
+            for d in all_decisions:
+                decisions_by_stage.setdefault(d.get('stage'), []).append(d)
             for stage_num, stage_name in enumerate(['refinement', 'hints', 'grouping', 'ambiguity_check'], 1):
-                stage_decisions = [d for d in all_decisions if d.get('stage') == stage_name]
+                stage_decisions = decisions_by_stage.get(stage_name)
                 if stage_decisions:
-                    f.write(f"\nSTAGE {stage_num} - {stage_name.upper()}:\n")
+                    parts.append(f"\nSTAGE {stage_num} - {stage_name.upper()}:\n")
                     for decision in stage_decisions:
-                        f.write(f"  Index: {decision.get('card_index', 'N/A')}\n")
-                        f.write(f"  Action: {decision.get('action', 'N/A')}\n")
-                        f.write(f"  Reason: {decision.get('reason', 'N/A')}\n")
-                        f.write("  " + "-"*30 + "\n")
-        
-        print(f"📄 Human-readable summary saved to: {summary_file}")
-        
-        self.logger.info(f"Multi-stage refinement complete:")
-        self.logger.info(f"  Stage 1: {stage1_data['removed']} removed, {stage1_data['merged']} merged, {stage1_data['modified']} modified")
-        self.logger.info(f"  Stage 2: {stage2_data['hints_added']} hints added")
-        self.logger.info(f"  Stage 3: {stage3_data['regrouped']} cards regrouped")
-        self.logger.info(f"  Stage 4: {stage4_data['modified']} cards clarified")
+                        parts.append(f"  Index: {decision.get('card_index', 'N/A')}\n"
+                                     f"  Action: {decision.get('action', 'N/A')}\n"
+                                     f"  Reason: {decision.get('reason', 'N/A')}\n"
+                                     "  " + "-"*30 + "\n")
+            
+            # Create human-readable summary in a single write
+            summary_file = refinement_log_file.with_suffix('.txt')
+            with open(summary_file, 'w', encoding='utf-8') as f:
+                f.write(''.join(parts))
+        
+            self.logger.info(f"Refinement logs saved to {refinement_log_file} and {summary_file}")
+        except Exception as e:
+            # Nothing waits on this background write, so report failures here
+            print(f"⚠️ Could not save refinement logs: {e}")
+            self.logger.error(f"Could not save refinement logs to {refinement_log_file}: {e}")
     
     def _process_refined_cards(self, refined_cards: List[Dict]) -> List[Dict]:
         """Process and organize refined cards back into slide structure."""
-        # Validate that cards still have cloze format
-        valid_cards = []
+        # Validate, format and group the cards by slide in a single pass;
+        # cards keep their refined order within each slide
+        renumber = self.convert_to_single_card_format if self.single_card_mode else None
+        add_bold = self.add_bold_formatting
+        cards_by_slide = {}
         for card in refined_cards:
-            if '{{c' in card.get('text', ''):
-                valid_cards.append(card)
-            else:
-                self.logger.warning(f"Skipping card without cloze format: {card.get('text', '')[:50]}...")
-        
-        # Reorganize refined cards back into slide structure
-        refined_data = {}
-        for card in valid_cards:
-            slide_num = card.get('slide', 1)
-            if slide_num not in refined_data:
-                refined_data[slide_num] = {
-                    'page_num': slide_num,
-                    'cards': []
-                }
-            
-            # Apply single card format if needed
-            card_text = card['text']
-            if self.single_card_mode:
-                card_text = self.convert_to_single_card_format(card_text)
-            
-            refined_data[slide_num]['cards'].append({
-                'text': self.add_bold_formatting(card_text),
-                'facts': card.get('facts', []),
-                'context': card.get('context', ''),
-                'clinical_relevance': card.get('clinical_relevance', '')
-            })
-        
-        refined_list = list(refined_data.values())
+            card_text = card.get('text', '')
+            if '{{c' not in card_text:
+                self.logger.warning(f"Skipping card without cloze format: {card_text[:50]}...")
+                continue
+            if renumber is not None:
+                card_text = renumber(card_text)
+            # The model may return the slide as a string or null; deck images
+            # are looked up by number, so anything unreadable goes to slide 1
+            try:
+                slide_num = int(card.get('slide', 1))
+            except (TypeError, ValueError):
+                self.logger.warning(f"Card has unreadable slide {card.get('slide')!r}, using slide 1: {card_text[:50]}...")
+                slide_num = 1
+            cards_by_slide.setdefault(slide_num, []).append(RefinedCard(
+                text=add_bold(card_text),
+                facts=card.get('facts', []),
+                context=card.get('context', ''),
+                clinical_relevance=card.get('clinical_relevance', '')
+            ))
+        
+        refined_list = [{'page_num': slide_num, 'cards': cards_by_slide[slide_num]}
+                        for slide_num in sorted(cards_by_slide)]
         total_refined_cards = sum(len(d['cards']) for d in refined_list)
         
         print(f"✅ Refinement complete: {len(refined_cards)} cards → {total_refined_cards} optimized cards")
@@ -1733,118 +2495,174 @@ class MedicalAnkiGenerator:
     
     def save_progress(self, progress_file: Path, progress_data: Dict):
         """Save progress to a file."""
-        with open(progress_file, 'wb') as f:
-            pickle.dump(progress_data, f)
+        # Serialize up front and swap the file in atomically so an interrupted
+        # save never leaves a truncated progress file behind
+        data = pickle.dumps(progress_data, protocol=pickle.HIGHEST_PROTOCOL)
+        temp_file = progress_file.with_suffix('.pkl.tmp')
+        with open(temp_file, 'wb', buffering=1 << 20) as f:
+            f.write(data)
+        os.replace(temp_file, progress_file)
     
     def load_progress(self, progress_file: Path) -> Optional[Dict]:
         """Load progress from a file."""
         if progress_file.exists():
             try:
-                with open(progress_file, 'rb') as f:
-                    return pickle.load(f)
+                return pickle.loads(progress_file.read_bytes())
             except Exception as e:
                 print(f"⚠️ Could not load progress file: {e}")
         return None
     
-    def create_anki_package(self, cards_data: List[Dict], lecture_name: str, images: List[Tuple[Image.Image, int]], 
+    def _save_slide_image(self, image: Image.Image, image_path: Path):
+        """Save a slide image as PNG for embedding in Anki cards."""
+        # Text-heavy slides use few colours, so a palette PNG is much smaller
+        # and cheaper to deflate; only used when asked for with --palette-images
+        if self.palette_images and image.mode == "RGB":
+            image = image.quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+        # Encode in memory, then write the whole buffer in one call (a buffered
+        # file keeps writing until every byte is out, unlike a bare os.write)
+        buffered = _scratch_buffer()
+        image.save(buffered, "PNG", compress_level=self._PNG_COMPRESS_LEVELS.get(self.compression_level, 1))
+        with open(image_path, 'wb') as f, buffered.getbuffer() as view:
+            f.write(view[:buffered.tell()])
+    
+    def create_anki_package(self, cards_data: List[Dict], lecture_name: str, pdf_path: str, 
                         output_dir: str, deck_suffix: str = ""):
         """Create Anki package (.apkg) with cards and images using genanki."""
         output_path = Path(output_dir)
         output_path.mkdir(parents=True, exist_ok=True)
         
-        deck_id = random.randrange(1 << 30, 1 << 31)
         deck_name = f'Medical::{lecture_name}{deck_suffix}'
+        # Derive the ID from the deck name so re-running a lecture updates the
+        # same Anki deck instead of creating a duplicate
+        name_hash = int.from_bytes(hashlib.blake2b(deck_name.encode('utf-8'), digest_size=4).digest(), 'big')
+        deck_id = (name_hash & ((1 << 30) - 1)) | (1 << 30)
         deck = genanki.Deck(deck_id, deck_name)
         
         media_files = []
-        page_to_image = {page_num: img for img, page_num in images}
-        
-        all_cards_text = []
         card_number = 1
+        total_cards = sum(len(slide_data['cards']) for slide_data in cards_data)
+        
+        # Create filenames with suffix
+        filename_suffix = deck_suffix.replace('::', '_').strip() if deck_suffix else ""
+        apkg_filename = output_path / f"{lecture_name}{filename_suffix}.apkg"
+        text_file = output_path / f"{lecture_name}{filename_suffix}_cards_reference.txt"
         
         temp_media_dir = output_path / "temp_media"
         temp_media_dir.mkdir(exist_ok=True)
         
-        card_mode_text = "Single Card Mode (all blanks shown together)" if self.single_card_mode else "Multiple Card Mode (separate cards for each blank)"
-        all_cards_text.append(f"Card Mode: {card_mode_text}")
-        if deck_suffix:
-            all_cards_text.append(f"Deck Type: {deck_suffix.replace('::', '').strip()}")
-        if self.custom_tags:
-            all_cards_text.append(f"Custom Tags: {', '.join(self.custom_tags)}")
-        if self.add_hints:
-            all_cards_text.append("Hint Mode: Enabled")
-        all_cards_text.append("-" * 50)
-        
+        # Collect the slide images that still need to be written to temp_media
+        page_count = self.get_page_count(pdf_path)
+        pending_pages = []
         for slide_data in cards_data:
             page_num = slide_data['page_num']
-            slide_cards = slide_data['cards']
-            
-            image_filename = f"slide_{lecture_name}_{page_num:03d}.png"
-            if page_num in page_to_image:
-                image_path = temp_media_dir / image_filename
+            if 1 <= page_num <= page_count:
+                image_path = temp_media_dir / f"slide_{lecture_name}_{page_num:03d}.png"
                 if not image_path.exists():
-                    # Always save at full quality for Anki cards
-                    page_to_image[page_num].save(image_path, "PNG", optimize=False)
+                    pending_pages.append(page_num)
                 media_files.append(str(image_path))
+        
+        # Pages are rendered lazily and encoded on a thread pool (Pillow releases
+        # the GIL while deflating); the queue of unencoded pages is kept short so
+        # memory stays flat, and the last encodes overlap with building notes
+        workers = max(1, min(len(pending_pages), os.cpu_count() or 1))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            image_jobs = deque()
+            for image, page_num in self.iter_pdf_images(pdf_path, pending_pages):
+                image_path = temp_media_dir / f"slide_{lecture_name}_{page_num:03d}.png"
+                image_jobs.append(executor.submit(self._save_slide_image, image, image_path))
+                if len(image_jobs) > workers * 2:
+                    image_jobs.popleft().result()
             
-            for card in slide_cards:
-                note_text = card['text']
-                note_text = self.escape_html_but_preserve_formatting(note_text)
-                
-                # Build extra content
-                extra_parts = [f'<img src="{image_filename}">']
-                if card.get('clinical_relevance'):
-                    clinical_text = html.escape(card['clinical_relevance'])
-                    extra_parts.append(f'<div class="clinical-pearl">💡 {clinical_text}</div>')
-                context_text = html.escape(card.get('context', ''))
-                extra_parts.append(f'<div class="context">Context: {context_text}</div>')
-                extra_content = '<br>'.join(extra_parts)
-                
-                # Combine default and custom tags
-                tags = [f'slide_{page_num}', lecture_name.replace(" ", "_"), 'medical'] + self.custom_tags
+            # The reference text is streamed to disk as notes are built; the
+            # buffered writer coalesces the small per-card writes
+            with open(text_file, 'w', encoding='utf-8', buffering=1 << 16) as cards_text:
+                cards_text.write(f"Anki Cards for {lecture_name}{deck_suffix}\n")
+                cards_text.write(f"Total cards: {total_cards}\n")
+                cards_text.write(f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+                image_quality = "256-colour palette" if self.palette_images else "Original (preserved)"
+                cards_text.write(f"Image Quality: {image_quality}\n")
+                cards_text.write("=" * 50 + "\n\n")
+            
+                card_mode_text = "Single Card Mode (all blanks shown together)" if self.single_card_mode else "Multiple Card Mode (separate cards for each blank)"
+                cards_text.write(f"Card Mode: {card_mode_text}\n")
+                if deck_suffix:
+                    cards_text.write(f"Deck Type: {deck_suffix.replace('::', '').strip()}\n")
+                if self.custom_tags:
+                    cards_text.write(f"Custom Tags: {', '.join(self.custom_tags)}\n")
+                if self.add_hints:
+                    cards_text.write("Hint Mode: Enabled\n")
+                cards_text.write("-" * 50 + "\n")
+            
+                # Tags other than the slide number are the same for every card
+                lecture_tag = lecture_name.replace(" ", "_")
+                base_tags = ['medical'] + self.custom_tags
                 if deck_suffix:
-                    tags.append(deck_suffix.replace('::', '').strip().lower())
+                    base_tags.append(deck_suffix.replace('::', '').strip().lower())
                 
-                note = genanki.Note(
-                    model=self.cloze_model,
-                    fields=[note_text, extra_content],
-                    tags=tags
-                )
-                deck.add_note(note)
+                def extra_with_clinical(image_filename, card):
+                    extra_parts = [f'<img src="{image_filename}">']
+                    if card.get('clinical_relevance'):
+                        clinical_text = card['clinical_relevance'].translate(self._HTML_ESCAPE_TABLE)
+                        extra_parts.append(f'<div class="clinical-pearl">💡 {clinical_text}</div>')
+                    context_text = card.get('context', '').translate(self._HTML_ESCAPE_TABLE)
+                    extra_parts.append(f'<div class="context">Context: {context_text}</div>')
+                    return '<br>'.join(extra_parts)
                 
-                # Add to text file
-                all_cards_text.append(f"Card {card_number} (Slide {page_num}):")
-                all_cards_text.append(f"Text: {note_text}")
-                all_cards_text.append(f"Facts tested: {', '.join(card.get('facts', []))}")
-                all_cards_text.append(f"Context: {card.get('context', 'N/A')}")
-                if card.get('clinical_relevance'):
-                    all_cards_text.append(f"Clinical Relevance: {card['clinical_relevance']}")
-                all_cards_text.append(f"Tags: {', '.join(tags)}")
-                all_cards_text.append("-" * 50)
+                def extra_context_only(image_filename, card):
+                    context_text = card.get('context', '').translate(self._HTML_ESCAPE_TABLE)
+                    return f'<img src="{image_filename}"><br><div class="context">Context: {context_text}</div>'
                 
-                card_number += 1
+                # Most decks have no clinical pearls, so pick the leaner builder once
+                has_clinical = any(card.get('clinical_relevance') for slide_data in cards_data for card in slide_data['cards'])
+                build_extra_content = extra_with_clinical if has_clinical else extra_context_only
+            
+                for slide_data in cards_data:
+                    page_num = slide_data['page_num']
+                    slide_cards = slide_data['cards']
+                    image_filename = f"slide_{lecture_name}_{page_num:03d}.png"
+                
+                    for card in slide_cards:
+                        note_text = card['text']
+                        note_text = self.escape_html_but_preserve_formatting(note_text)
+                    
+                        extra_content = build_extra_content(image_filename, card)
+                    
+                        # Combine default and custom tags
+                        tags = [f'slide_{page_num}', lecture_tag] + base_tags
+                    
+                        note = genanki.Note(
+                            model=self.cloze_model,
+                            fields=[note_text, extra_content],
+                            tags=tags
+                        )
+                        deck.add_note(note)
+                    
+                        # Add to text file
+                        cards_text.write(f"Card {card_number} (Slide {page_num}):\n")
+                        cards_text.write(f"Text: {note_text}\n")
+                        cards_text.write(f"Facts tested: {', '.join(card.get('facts', []))}\n")
+                        cards_text.write(f"Context: {card.get('context', 'N/A')}\n")
+                        if card.get('clinical_relevance'):
+                            cards_text.write(f"Clinical Relevance: {card['clinical_relevance']}\n")
+                        cards_text.write(f"Tags: {', '.join(tags)}\n")
+                        cards_text.write("-" * 50 + "\n")
+                    
+                        card_number += 1
+            
+            for job in image_jobs:
+                job.result()
         
         package = genanki.Package(deck)
         package.media_files = media_files
-        
-        # Create filename with suffix
-        filename_suffix = deck_suffix.replace('::', '_').strip() if deck_suffix else ""
-        apkg_filename = output_path / f"{lecture_name}{filename_suffix}.apkg"
         package.write_to_file(str(apkg_filename))
         
-        text_file = output_path / f"{lecture_name}{filename_suffix}_cards_reference.txt"
-        with open(text_file, 'w', encoding='utf-8') as f:
-            f.write(f"Anki Cards for {lecture_name}{deck_suffix}\n")
-            f.write(f"Total cards: {card_number - 1}\n")
-            f.write(f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write("Image Quality: Original (preserved)\n")
-            f.write("=" * 50 + "\n\n")
-            f.write("\n".join(all_cards_text))
-        
         print(f"\n✅ Successfully created {card_number - 1} flashcards")
         if self.card_style:
             print(f"🎨 Custom styling applied: {', '.join([f'{k}={v}' for k, v in self.card_style.items()])}")
-        print("🖼️ Original image quality preserved in Anki cards")
+        if self.palette_images:
+            print("🖼️ Slide images saved as 256-colour PNGs in Anki cards")
+        else:
+            print("🖼️ Original image quality preserved in Anki cards")
         print(f"📦 Anki package saved: {apkg_filename}")
         print(f"📄 Reference text saved: {text_file}")
         
@@ -1871,14 +2689,14 @@ class MedicalAnkiGenerator:
             if progress_data:
                 print(f"📂 Found existing progress: {len(progress_data['completed_slides'])} slides already processed")
         
-        print("📄 Converting PDF to images...")
-        images = self.pdf_to_images(pdf_path)
-        print(f"✅ Extracted {len(images)} slides")
+        # Pages are rendered on demand, so only their count is needed up front
+        total_slides = self.get_page_count(pdf_path)
+        print(f"📄 Found {total_slides} slides")
         
         if progress_data is None:
             progress_data = {
                 'lecture_name': lecture_name,
-                'total_slides': len(images),
+                'total_slides': total_slides,
                 'completed_slides': [],
                 'cards_data': [],
                 'start_time': datetime.now().isoformat(),
@@ -1889,11 +2707,25 @@ class MedicalAnkiGenerator:
         completed_slides = set(progress_data['completed_slides'])
         
         # Always use batch processing
-        remaining_images = [(img, page_num) for img, page_num in images if page_num not in completed_slides]
-        
-        if remaining_images:
-            print(f"\n🔄 Batch processing {len(remaining_images)} remaining slides...")
-            batch_results = self.analyze_slides_batch(remaining_images, lecture_name)
+        remaining_pages = [page_num for page_num in range(1, total_slides + 1) if page_num not in completed_slides]
+        
+        # The prompt tells the model to skip these slides anyway, so don't pay to upload them
+        if remaining_pages and self.skip_boilerplate_slides:
+            boilerplate_slides = self._find_boilerplate_slides(pdf_path, remaining_pages)
+            if boilerplate_slides:
+                print(f"⏭️ Skipping {len(boilerplate_slides)} reference/acknowledgement/disclosure slides: {sorted(boilerplate_slides)}")
+                self.logger.info(f"Skipped boilerplate slides without analysis: {sorted(boilerplate_slides)}")
+                completed_slides.update(boilerplate_slides)
+                remaining_pages = [page_num for page_num in remaining_pages if page_num not in boilerplate_slides]
+        
+        if remaining_pages:
+            print(f"\n🔄 Batch processing {len(remaining_pages)} remaining slides...")
+            # Compressed uploads are rasterized straight at the upload size
+            api_max_size = None
+            if self.compression_level != "none":
+                api_max_size = self.compression_settings[self.compression_level]["max_size"]
+            batch_results = self.analyze_slides_batch(
+                self.iter_pdf_images(pdf_path, remaining_pages, max_size=api_max_size), lecture_name)
             
             if batch_results:
                 for slide_data in batch_results:
@@ -1905,6 +2737,10 @@ class MedicalAnkiGenerator:
                 progress_data['cards_data'] = all_cards_data
                 progress_data['last_update'] = datetime.now().isoformat()
                 self.save_progress(progress_file, progress_data)
+                
+                if not completed_slides.issuperset(remaining_pages):
+                    print("⚠️ Some slide batches failed - progress saved, re-run to resume the remaining slides")
+                    return None
             else:
                 print("⚠️ Batch processing failed")
                 return None
@@ -1913,7 +2749,7 @@ class MedicalAnkiGenerator:
         if budget_mode and all_cards_data:
             # Budget mode - only create original deck
             print("\n📦 Creating deck (budget mode - no refinement)...")
-            apkg_path = self.create_anki_package(all_cards_data, lecture_name, images, output_dir)
+            apkg_path = self.create_anki_package(all_cards_data, lecture_name, pdf_path, output_dir)
             self._cleanup_temp_files(output_dir, progress_file)
             return apkg_path
         else:
@@ -1922,7 +2758,7 @@ class MedicalAnkiGenerator:
                 refined_cards_data = self.critique_and_refine_cards(all_cards_data, lecture_name)
                 
                 print("\n📦 Creating refined deck...")
-                refined_apkg = self.create_anki_package(refined_cards_data, lecture_name, images, output_dir)
+                refined_apkg = self.create_anki_package(refined_cards_data, lecture_name, pdf_path, output_dir)
                 
                 self._cleanup_temp_files(output_dir, progress_file)
                 
@@ -1940,9 +2776,10 @@ class MedicalAnkiGenerator:
         """Clean up temporary files after processing."""
         temp_media_dir = Path(output_dir) / "temp_media"
         if temp_media_dir.exists():
-            for file in temp_media_dir.glob("*"):
-                file.unlink()
-            temp_media_dir.rmdir()
+            with os.scandir(temp_media_dir) as entries:
+                for entry in entries:
+                    os.unlink(entry.path)
+            os.rmdir(temp_media_dir)
         
         if progress_file.exists():
             progress_file.unlink()
@@ -1963,15 +2800,29 @@ class MedicalAnkiGenerator:
         
         progress_dir = Path(output_dir) / "progress"
         progress_dir.mkdir(parents=True, exist_ok=True)
-        folder_progress_file = progress_dir / "folder_progress.json"
+        # Append-only log with one line per completed lecture; older runs
+        # left a single JSON file that is still read when resuming
+        folder_progress_file = progress_dir / "folder_progress.jsonl"
+        legacy_progress_file = progress_dir / "folder_progress.json"
         
         completed_files = set()
-        if resume and folder_progress_file.exists():
+        if not resume:
+            for progress_file in (folder_progress_file, legacy_progress_file):
+                if progress_file.exists():
+                    progress_file.unlink()
+        elif folder_progress_file.exists() or legacy_progress_file.exists():
             try:
-                with open(folder_progress_file, 'r') as f:
-                    folder_progress = json.load(f)
-                    completed_files = set(folder_progress.get('completed_files', []))
-                    print(f"📂 Found folder progress: {len(completed_files)} files already completed")
+                if legacy_progress_file.exists():
+                    completed_files.update(_load_json(legacy_progress_file.read_bytes()).get('completed_files', []))
+                if folder_progress_file.exists():
+                    with open(folder_progress_file, 'rb') as f:
+                        for line in f:
+                            try:
+                                completed_files.add(_load_json(line)['path'])
+                            except (ValueError, KeyError, TypeError):
+                                # Blank or half-written line from an interrupted run
+                                continue
+                print(f"📂 Found folder progress: {len(completed_files)} files already completed")
             except Exception as e:
                 print(f"⚠️ Could not load folder progress: {e}")
         
@@ -1991,16 +2842,13 @@ class MedicalAnkiGenerator:
                 
                 if x: 
                     completed_files.add(str(pdf_file))
-                folder_progress = {
-                    'completed_files': list(completed_files),
-                    'total_files': len(pdf_files),
-                    'last_update': datetime.now().isoformat(),
-                    'single_card_mode': self.single_card_mode
-                }
-                progress_dir.mkdir(exist_ok=True)
-                with open(folder_progress_file, 'w') as f:
-                    json.dump(folder_progress, f, indent=2)
-                    
+                    progress_dir.mkdir(exist_ok=True)
+                    with open(folder_progress_file, 'ab') as f:
+                        f.write(_dump_json_bytes({
+                            'path': str(pdf_file),
+                            'completed': datetime.now().isoformat()
+                        }) + b'\n')
+                
             except Exception as e:
                 print(f"\n❌ Error processing {pdf_file.name}: {str(e)}")
                 print("💾 Progress saved - you can resume later")
@@ -2009,27 +2857,29 @@ class MedicalAnkiGenerator:
         print(f"✅ Successfully processed {successful}/{len(pdf_files)} lectures")
         print(f"📁 All output saved to: {Path(output_dir).absolute()}")
         
-        if successful == len(pdf_files) and folder_progress_file.exists():
-            folder_progress_file.unlink()
+        if successful == len(pdf_files) and (folder_progress_file.exists() or legacy_progress_file.exists()):
+            for progress_file in (folder_progress_file, legacy_progress_file):
+                if progress_file.exists():
+                    progress_file.unlink()
             print("🧹 Cleaned up folder progress file")
 
 
 
+_STYLE_OPTION_PATTERN = re.compile(r'(?:^|,)\s*([^=,]*?)\s*=\s*([^,]*?)\s*(?=,|$)')
+_TAG_PATTERN = re.compile(r'[^,\s][^,]*[^,\s]|[^,\s]')
+
+
 def parse_style_options(style_string: str) -> Dict:
     """Parse style options from command line string."""
-    style = {}
     if style_string:
-        for option in style_string.split(','):
-            if '=' in option:
-                key, value = option.split('=', 1)
-                style[key.strip()] = value.strip()
-    return style
+        return dict(_STYLE_OPTION_PATTERN.findall(style_string))
+    return {}
 
 
 def parse_tags(tags_string: str) -> List[str]:
     """Parse custom tags from command line string."""
     if tags_string:
-        return [tag.strip() for tag in tags_string.split(',')]
+        return _TAG_PATTERN.findall(tags_string)
     return []
 
 
@@ -2065,6 +2915,15 @@ def main():
         print("  --tags=tag1,tag2     Add custom tags to all cards")
         print("  --style=key=value    Custom styling (see examples)")
         print("  --test-mode          Require Enter key before each API call")
+        print("  --slides-per-request=N  Split slide analysis into requests of N slides")
+        print("  --concurrency=N      Max concurrent requests when splitting [default: 4]")
+        print("  --analyze-all-slides Also send reference/acknowledgement/disclosure slides to the API")
+        print("  --no-cache           Ignore and don't save cached API results")
+        print("  --quality-gate       Skip the first refinement stage when cards already pass basic checks")
+        print("  --cache-dir=PATH     Folder for cached API results [default: .ankify_cache]")
+        print("  --flex-processing    Use the cheaper, slower flex service tier for all requests")
+        print("  --flex-refinement    Use the flex service tier for refinement stages only")
+        print("  --palette-images     Store deck slide images as smaller 256-colour PNGs")
         print("\nStyle options:")
         print("  background=#hexcolor    Background color")
         print("  text_color=#hexcolor    Main text color")
@@ -2095,6 +2954,18 @@ def main():
     test_mode = "--test-mode" in sys.argv
     add_hints = "--no-hints" not in sys.argv  # Inverted logic
     flex_mode = "--flex-processing" in sys.argv #OpenAI flex mode pricing
+    flex_refinement = "--flex-refinement" in sys.argv
+    skip_boilerplate_slides = "--analyze-all-slides" not in sys.argv
+    quality_gate = "--quality-gate" in sys.argv
+    palette_images = "--palette-images" in sys.argv
+    
+    # Parse API result cache location
+    cache_dir = ".ankify_cache"
+    for arg in sys.argv:
+        if arg.startswith("--cache-dir="):
+            cache_dir = arg.split("=", 1)[1] or cache_dir
+    if "--no-cache" in sys.argv:
+        cache_dir = None
     
     # Parse compression level
     compression_level = "high"  # Default
@@ -2106,6 +2977,20 @@ def main():
             else:
                 print(f"⚠️ Invalid compression level '{level}', using 'high'")
     
+    # Parse request splitting
+    slides_per_request = None
+    max_concurrent_requests = 4
+    for arg in sys.argv:
+        if arg.startswith("--slides-per-request=") or arg.startswith("--concurrency="):
+            option, value = arg.split("=", 1)
+            if value.isdigit() and int(value) > 0:
+                if option == "--slides-per-request":
+                    slides_per_request = int(value)
+                else:
+                    max_concurrent_requests = int(value)
+            else:
+                print(f"⚠️ Invalid value '{value}' for {option}, ignoring")
+    
     # Parse custom tags
     custom_tags = []
     for arg in sys.argv:
@@ -2136,6 +3021,13 @@ def main():
         test_mode=test_mode,
         add_hints=add_hints,
         flex_mode=flex_mode,
+        slides_per_request=slides_per_request,
+        max_concurrent_requests=max_concurrent_requests,
+        skip_boilerplate_slides=skip_boilerplate_slides,
+        cache_dir=cache_dir,
+        quality_gate=quality_gate,
+        flex_refinement=flex_refinement,
+        palette_images=palette_images,
     )
     
     if os.path.isfile(path) and path.endswith('.pdf'):